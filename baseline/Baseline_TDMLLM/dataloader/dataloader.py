@@ -2,20 +2,184 @@ import os
 import json
 import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from tqdm import tqdm
 
 from summarize_module.summarizer import Summarizer
+from summarize_module.summary_store import read_stored_summaries
+from dataloader.price_table import PriceCache, default_price_cache_dir, load_price_table
+from dataloader.tweet_store import PackedTweetReader, default_packed_tweet_dir
+from dataloader.tweet_filter import filter_tweets
+from dataloader.relevance_filter import build_relevance_filter
+from dataloader.dataset_cache import DatasetCache, fingerprint
+
+
+def get_sentiment(date_str, price_table):
+    price_chg = price_table.get_movement(date_str)
+
+    if price_chg > 0.0:
+        sentiment = "Positive"
+    else:
+        sentiment = "Negative"
+    return sentiment
+
+
+class PartitionBuilder:
+    """Builds the partition of one ticker in a split: price table, data range, day table and window samples.
+
+    Picklable (the summary store reconnects in each process), so with
+    `--load_workers` > 1 whole partitions are built in a process pool from
+    the price files and the stored summaries.
+    """
+
+    def __init__(self, flag, dataset_name, seq_len, train_ratio, start_date, end_date, price_cache, store, logger):
+        self.flag = flag
+        self.dataset_name = dataset_name
+        self.seq_len = seq_len
+        self.train_ratio = train_ratio
+        self.start_date = start_date
+        self.end_date = end_date
+        self.price_cache = price_cache
+        self.store = store
+        self.logger = logger
+
+    def window_days(self, end_dates):
+        """Sorted calendar days covered by at least one window ending at `end_dates`.
+
+        The window of an end date is the `seq_len` days before it, end date excluded.
+        """
+        offsets = np.arange(1, self.seq_len + 1)
+        return np.unique(end_dates[:, None] - offsets[None, :])
+
+    def partition(self, price_path):
+        """(ticker, price_table, data_range, end_dates, window days) of a price file, or None if it has no rows."""
+        price_table = load_price_table(price_path, self.price_cache)
+        ticker = price_table.ticker
+
+        # 獲取有效的數據索引
+        if self.dataset_name == "ACL18":
+            valid_indices = price_table.indices_between(self.start_date, self.end_date)
+
+            if not valid_indices:
+                self.logger.warning(f"No data found in specified date range for {ticker}")
+                return None
+            data_to_process = valid_indices
+        else:
+            data_to_process = range(len(price_table))
+
+        tes_idx = round(len(data_to_process) * self.train_ratio)
+        end_idx = len(data_to_process)
+        data_range = data_to_process[:tes_idx] if self.flag == "train" else data_to_process[tes_idx:end_idx]
+        end_dates = price_table.dates[np.asarray(data_range, dtype=int)]
+        return ticker, price_table, data_range, end_dates, self.window_days(end_dates)
+
+    def samples(self, partition, day_dates, day_entries, log_dates=False):
+        """The window samples of a partition, given its informative days and the text each contributes."""
+        ticker, price_table, data_range, end_dates, _ = partition
+        # 以 searchsorted 切出各視窗 [end - seq_len, end)
+        window_starts = np.searchsorted(day_dates, end_dates - self.seq_len, side="left")
+        window_stops = np.searchsorted(day_dates, end_dates, side="left")
+        window_start_strs = np.datetime_as_string(end_dates - self.seq_len, unit="D").tolist()
+
+        samples = []
+        for idx, window_start_str, start, stop in zip(data_range, window_start_strs, window_starts, window_stops):
+            end_date_str = price_table.date_strs[idx]
+            if log_dates:
+                tqdm.write(f"End Date: {end_date_str}")
+            if stop > start:
+                samples.append({
+                    'ticker': ticker,
+                    'start_date': window_start_str,
+                    'end_date': end_date_str,
+                    'summary': "".join(day_entries[start:stop]).rstrip(),
+                    'target': get_sentiment(end_date_str, price_table)
+                })
+        return samples
+
+    def build(self, price_path):
+        """Build a partition from the stored summaries alone, as (partition, stored summaries, samples).
+
+        When a window day has no stored summary the samples are None and the
+        caller summarizes the missing days; a finished partition comes back
+        as (None, None, samples) so its price table is not sent back. A price
+        file without rows in the split gives (None, None, []).
+        """
+        partition = self.partition(price_path)
+        if partition is None:
+            return None, None, []
+        ticker, *_, days = partition
+        date_strs = np.datetime_as_string(days, unit="D").tolist()
+        stored = read_stored_summaries(self.store, ticker, date_strs)
+        if len(stored) < len(date_strs):
+            return partition, stored, None
+
+        # 非資訊性的日子在 store 中已記為 None
+        informative = [(day, date_str) for day, date_str in zip(days, date_strs) if stored[date_str]]
+        day_dates = np.array([day for day, _ in informative], dtype="datetime64[D]")
+        day_entries = [date_str + "\n" + stored[date_str] + "\n\n" for _, date_str in informative]
+        return None, None, self.samples(partition, day_dates, day_entries)
+
+
+_worker_builder = None
+
+
+def _init_load_worker(builder):
+    # builder（與其 store 連線）每個 worker 只還原一次，而非每個股票一次
+    global _worker_builder
+    _worker_builder = builder
+
+
+def _build_partition(price_path):
+    return _worker_builder.build(price_path)
+
 
 class DataLoader:
+    SAMPLE_COLUMNS = ['ticker', 'start_date', 'end_date', 'summary', 'target']
+    TRAIN_RATIO = 0.8
+
     def __init__(self, args, logger):
         self.logger = logger
         self.price_dir = args.price_dir
         self.tweet_dir = args.tweet_dir
         self.seq_len = args.seq_len
+        self.load_workers = args.load_workers
+        self.revalidate_summaries = args.revalidate_summaries
+        self.tweet_filter = args.tweet_filter
+        # 以句向量相似度只保留與該股票最相關的 top-k 則推文/新聞
+        self.relevance_filter = build_relevance_filter(args)
         self.summarizer = Summarizer(args, logger)
         self.summary_cache = {}  # 新增快取字典
         self.dataset_name = args.dataset_name
+        self.price_cache = None
+        if not args.no_price_cache:
+            price_cache_dir = args.price_cache_dir or default_price_cache_dir(self.price_dir)
+            try:
+                self.price_cache = PriceCache(price_cache_dir, logger)
+            except OSError as e:
+                self.logger.warning(f"Price cache disabled, cannot use {price_cache_dir}: {e}")
+        # 若已執行 `python -m dataloader.tweet_store` 打包推文，改從打包檔讀取
+        self.tweet_reader = None
+        self.stale_tickers = set()
+        packed_tweet_dir = args.packed_tweet_dir or default_packed_tweet_dir(self.tweet_dir)
+        if PackedTweetReader.is_packed(packed_tweet_dir):
+            self.tweet_reader = PackedTweetReader(packed_tweet_dir)
+            self.logger.info(f"Using packed tweets from {packed_tweet_dir}")
+            # 打包後才新增或變動的股票改讀原始推文，不會少讀
+            self.stale_tickers = self.tweet_reader.stale_tickers(self.tweet_dir)
+            if self.stale_tickers:
+                self.logger.warning(
+                    f"⚠️ {len(self.stale_tickers)} tickers changed since packing, reading them from {self.tweet_dir} "
+                    f"(repack with `python -m dataloader.tweet_store`): {sorted(self.stale_tickers)}"
+                )
+        # 以設定指紋快取建好的資料集 (parquet)
+        self.dataset_cache = None
+        if not args.no_dataset_cache:
+            dataset_cache_dir = args.dataset_cache_dir or os.path.join(self.summarizer.dataset_root, "datasets")
+            try:
+                self.dataset_cache = DatasetCache(dataset_cache_dir, logger)
+            except OSError as e:
+                self.logger.warning(f"Dataset cache disabled, cannot use {dataset_cache_dir}: {e}")
         # 只在 ACL18 數據集時設置時間範圍
         if self.dataset_name == "ACL18":
             self.start_date = datetime(2014, 1, 1)
@@ -35,23 +199,62 @@ class DataLoader:
             cache_key = f"{ticker}_{date_str}"
             self.summary_cache[cache_key] = summary
 
-    def daterange(self, start_date, end_date):
-        for n in range(int((end_date - start_date).days)):
-            yield start_date + timedelta(n)
+    def get_day_summary(self, ticker, date_str):
+        # 檢查快取
+        cached_summary = self.get_cached_summary(ticker, date_str)
+        if cached_summary is not None:
+            self.logger.info(f"📋 Using cached summary for {ticker} on {date_str}")
+            return cached_summary
 
+        tweet_data = self.get_tweets(ticker, date_str)
+        summary = self.summarizer.get_summary(ticker, date_str, tweet_data)
+        # 存入快取
+        self.cache_summary(ticker, date_str, summary)
+        return summary
 
-    def get_sentiment(self, date_str, price_path):
-        price_data = np.genfromtxt(price_path, dtype=str, skip_header=False)
-        price_chg = price_data[price_data[:, 0] == date_str][0, 1].astype(float)
+    def build_day_table(self, ticker, days, stored_summaries=None):
+        """Look up every day once and keep the informative ones.
 
-        if price_chg > 0.0:
-            sentiment = "Positive"
-        else:
-            sentiment = "Negative"
-        return sentiment
+        `stored_summaries` holds the days read from (or just added to) the
+        summary store; the rest go through `get_day_summary`. Returns the informative days (sorted
+        datetime64) and, aligned with them, the text each contributes to a
+        window summary.
+        """
+        informative_days = []
+        entries = []
+        for day, date_str in zip(days, np.datetime_as_string(days, unit="D").tolist()):
+            if stored_summaries is not None and date_str in stored_summaries:
+                summary = stored_summaries[date_str]
+                self.cache_summary(ticker, date_str, summary)
+            else:
+                summary = self.get_day_summary(ticker, date_str)
+            if summary and self.summarizer.is_informative(summary):
+                informative_days.append(day)
+                entries.append(date_str + "\n" + summary + "\n\n")
+        return np.array(informative_days, dtype="datetime64[D]"), entries
 
 
     def get_tweets(self, ticker, date_str):
+        tweets = self.read_tweets(ticker, date_str)
+        if self.tweet_filter and tweets:
+            filtered = filter_tweets(tweets)
+            self.logger.info(f"🧹 Kept {len(filtered)} of {len(tweets)} tweets after dedup and spam filtering")
+            tweets = filtered
+        if self.relevance_filter is not None and tweets:
+            relevant = self.relevance_filter.filter(ticker, tweets)
+            self.logger.info(f"🎯 Kept {len(relevant)} of {len(tweets)} tweets most relevant to {ticker}")
+            tweets = relevant
+        return tweets
+
+    def read_tweets(self, ticker, date_str):
+        if self.tweet_reader is not None and ticker not in self.stale_tickers:
+            if not self.tweet_reader.has_day(ticker, date_str):
+                self.logger.warning(f"❌ No packed tweets for {ticker} on {date_str}")
+                return []
+            tweets = self.tweet_reader.get_tweets(ticker, date_str)
+            self.logger.info(f"📊 Loaded {len(tweets)} tweets")
+            return tweets
+
         tweets = []
         tweet_path = os.path.join(self.tweet_dir, ticker, date_str)
         
@@ -72,71 +275,176 @@ class DataLoader:
         return tweets
 
 
-    def load(self, flag):
-        data = pd.DataFrame()
-        stock_files = os.listdir(self.price_dir)
-        
-        with tqdm(total=len(stock_files), desc="Processing Stocks", position=0, leave=True) as outer_bar:
-            for file in os.listdir(self.price_dir):
-                price_path = os.path.join(self.price_dir, file)
-                ordered_price_data = np.flip(np.genfromtxt(price_path, dtype=str, skip_header=False), 0)
-                ticker = file[:-4]
-
-                # 獲取有效的數據索引
-                if self.dataset_name == "ACL18":
-                    valid_indices = []
-                    for idx in range(len(ordered_price_data)):
-                        date_str = ordered_price_data[idx, 0]
-                        current_date = datetime.strptime(date_str, "%Y-%m-%d")
-                        if self.start_date <= current_date <= self.end_date:
-                            valid_indices.append(idx)
-
-                    if not valid_indices:
-                        self.logger.warning(f"No data found in specified date range for {ticker}")
-                        continue
-                    data_to_process = valid_indices
-                else:
-                    data_to_process = range(len(ordered_price_data))
-
-                tes_idx = round(len(data_to_process) * 0.8)
-                end_idx = len(data_to_process)
-                data_range = data_to_process[:tes_idx] if flag == "train" else data_to_process[tes_idx:end_idx]
-
-                with tqdm(total=len(data_range), desc=f"{ticker} Processing", position=1, leave=True) as inner_bar:
-                    for idx in data_range:
-                        summary_all = ""
-
-                        end_date_str = ordered_price_data[idx, 0]
-                        end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
-                        start_date = end_date - timedelta(days=self.seq_len)
-                        target = self.get_sentiment(end_date_str, price_path)
-                        
-                        for seq_date in self.daterange(start_date, end_date):
-                            seq_date_str = seq_date.strftime("%Y-%m-%d")
-
-                            # 檢查快取
-                            cached_summary = self.get_cached_summary(ticker, seq_date_str)
-                            if cached_summary is not None:
-                                summary = cached_summary
-                                self.logger.info(f"📋 Using cached summary for {ticker} on {seq_date_str}")
-                            else:
-                                tweet_data = self.get_tweets(ticker, seq_date_str)
-                                summary = self.summarizer.get_summary(ticker, seq_date_str, tweet_data)
-                                # 存入快取
-                                self.cache_summary(ticker, seq_date_str, summary)
-
-                            if summary and summary is not None and summary != "" and self.summarizer.is_informative(summary):
-                                summary_all = summary_all + seq_date_str + "\n" + summary + "\n\n"
-
-                        if summary_all != "":
-                            data = pd.concat([data, pd.DataFrame([{
-                                'ticker': ticker,
-                                'summary': summary_all.rstrip(),
-                                'target': target
-                            }])], ignore_index=True)
-
-                        tqdm.write(f"End Date: {end_date_str}")
-                        inner_bar.update(1)
-                outer_bar.update(1)
+    def load(self, flag, stream=False):
+        """Build the samples of a split.
+
+        Returns a DataFrame with one row per sample, or, with `stream=True`,
+        a generator of sample dicts (see `stream_samples`) so callers can
+        start consuming samples while later tickers are still being built
+        (and summarized). Both read the dataset cache when it has the split.
+        """
+        if stream:
+            return self.stream_samples(flag)
+
+        if self.dataset_cache is None:
+            return pd.DataFrame.from_records(list(self.iter_samples(flag)), columns=self.SAMPLE_COLUMNS)
+
+        data = self.load_cached(flag)
+        if data is not None:
+            return data
+        skipped_days = self.summarizer.skipped_days
+        data = pd.DataFrame.from_records(list(self.iter_samples(flag)), columns=self.SAMPLE_COLUMNS)
+        self.save_cached(flag, data, skipped_days)
+        return data
+
+    def stream_samples(self, flag):
+        """Yield the samples of a split: all at once from the dataset cache, else as `iter_samples` builds them.
+
+        A split streamed to the end is then saved to the dataset cache.
+        """
+        data = self.load_cached(flag)
+        if data is not None:
+            yield from data.to_dict("records")
+            return
+
+        skipped_days = self.summarizer.skipped_days
+        samples = []
+        for sample in self.iter_samples(flag, summarize_ahead=False):
+            if self.dataset_cache is not None:
+                samples.append(sample)
+            yield sample
+        if self.dataset_cache is not None:
+            self.save_cached(flag, pd.DataFrame.from_records(samples, columns=self.SAMPLE_COLUMNS), skipped_days)
+
+    def load_cached(self, flag):
+        """The split from the dataset cache, or None."""
+        # 重新驗證摘要時推文可能已變動，不沿用快取的資料集
+        if self.dataset_cache is None or self.revalidate_summaries:
+            return None
+        key = fingerprint(self.get_build_config(flag))
+        data = self.dataset_cache.load(key)
+        if data is not None:
+            self.logger.info(f"📦 Loaded cached {flag} dataset {key} ({len(data)} samples)")
+        return data
+
+    def save_cached(self, flag, data, skipped_days):
+        """Save a built split to the dataset cache; `skipped_days` is the summarizer's count before the build."""
+        # 缺摘要（略過或生成失敗）的交易日之後補齊時指紋不一定改變，不寫入快取
+        if self.summarizer.skipped_days > skipped_days:
+            self.logger.warning(
+                f"⚠️ Not caching the {flag} dataset: {self.summarizer.skipped_days - skipped_days} ticker-days have no summary"
+            )
+            return
+        # 建置期間新存入的摘要會改變摘要庫狀態，以建完後的指紋存檔
+        config = self.get_build_config(flag)
+        key = fingerprint(config)
+        path = self.dataset_cache.save(key, config, data)
+        if path:
+            self.logger.info(f"💾 Saved {flag} dataset to {path}")
 
-            return data
\ No newline at end of file
+    def get_build_config(self, flag):
+        """Everything a built split depends on; its hash keys the dataset cache.
+
+        Besides the settings this covers the state of every ticker's tweet
+        files (edited tweets make their stored summaries stale) and of the
+        summary index (any summary stored or re-indexed since).
+        """
+        price_files = sorted(os.listdir(self.price_dir))
+        price_stats = [(file, os.stat(os.path.join(self.price_dir, file)).st_mtime_ns) for file in price_files]
+        store = self.summarizer.store
+        tweet_states = {file[:-4]: store.tweet_states.ticker_states(file[:-4]) for file in price_files}
+        return {
+            "flag": flag,
+            "dataset_name": self.dataset_name,
+            "price_dir": os.path.abspath(self.price_dir),
+            "price_files": price_stats,
+            "tweet_dir": os.path.abspath(self.tweet_dir),
+            "seq_len": self.seq_len,
+            "train_ratio": self.TRAIN_RATIO,
+            "start_date": self.start_date,
+            "end_date": self.end_date,
+            "summary_model": self.summarizer.model_name,
+            "summary_method": self.summarizer.method_name,
+            "summary_fingerprint": store.fingerprint,
+            "summary_index": store.index_state(),
+            "tweet_states": fingerprint(tweet_states),
+            "summaries_only_from_cache": self.summarizer.cache_only,
+            "columns": self.SAMPLE_COLUMNS
+        }
+
+    def partition_builder(self, flag):
+        return PartitionBuilder(
+            flag, self.dataset_name, self.seq_len, self.TRAIN_RATIO, self.start_date, self.end_date,
+            self.price_cache, self.summarizer.store, self.logger
+        )
+
+    def iter_built_partitions(self, builder, price_paths):
+        """`builder.build` of every price file, in price file order.
+
+        With `--load_workers` > 1 the partitions are built in a process pool;
+        the merged output does not depend on worker scheduling.
+        """
+        if self.load_workers <= 1:
+            yield from map(builder.build, price_paths)
+            return
+
+        self.logger.info(f"Building {len(price_paths)} ticker partitions with {self.load_workers} workers")
+        chunksize = max(1, len(price_paths) // (self.load_workers * 4))
+        with ProcessPoolExecutor(max_workers=self.load_workers, initializer=_init_load_worker, initargs=(builder,)) as executor:
+            yield from executor.map(_build_partition, price_paths, chunksize=chunksize)
+
+    def summarize_missing_days(self, partitions, stored):
+        """Generate every summary the split still lacks in batched LLM calls.
+
+        Fills the per-partition `stored` dicts in place with the new summaries.
+        """
+        requests = []
+        for (ticker, *_, days), stored_summaries in zip(partitions, stored):
+            for date_str in np.datetime_as_string(days, unit="D").tolist():
+                if date_str in stored_summaries or self.get_cached_summary(ticker, date_str) is not None:
+                    continue
+                requests.append((ticker, date_str, self.get_tweets(ticker, date_str)))
+        if not requests:
+            return
+
+        self.logger.info(f"📝 Summarizing {len(requests)} missing ticker-days in batches")
+        summaries = self.summarizer.get_summaries(requests)
+        stored_by_ticker = {partition[0]: stored_summaries for partition, stored_summaries in zip(partitions, stored)}
+        for (ticker, date_str, _), summary in zip(requests, summaries):
+            stored_by_ticker[ticker][date_str] = summary
+
+    def iter_samples(self, flag, summarize_ahead=True):
+        """Yield the samples of a split ticker by ticker.
+
+        Partitions whose days are all in the summary store are built by
+        `PartitionBuilder.build` (in `--load_workers` processes). For the
+        others, with `summarize_ahead` every summary the split lacks is
+        generated in one batched pass before the first sample; otherwise
+        each ticker's missing days are summarized right before its samples,
+        so a consumer (e.g. a `Prefetcher`) gets the first samples early.
+        """
+        builder = self.partition_builder(flag)
+        price_paths = [os.path.join(self.price_dir, file) for file in os.listdir(self.price_dir)]
+
+        if self.revalidate_summaries:
+            # 每個交易日都重新比對 prompt 雜湊，推文檔有變動的日子才會重新摘要
+            built = ((builder.partition(price_path), {}, None) for price_path in price_paths)
+        else:
+            built = self.iter_built_partitions(builder, price_paths)
+        summarize = self.revalidate_summaries or not self.summarizer.cache_only
+        if summarize and summarize_ahead:
+            built = list(built)
+            missing = [(partition, stored) for partition, stored, samples in built if samples is None and partition is not None]
+            self.summarize_missing_days([partition for partition, _ in missing], [stored for _, stored in missing])
+
+        with tqdm(total=len(price_paths), desc="Processing Stocks", position=0, leave=True) as outer_bar:
+            for partition, stored_summaries, samples in built:
+                if samples is None and partition is not None:
+                    if summarize and not summarize_ahead:
+                        self.summarize_missing_days([partition], [stored_summaries])
+                    # 每個交易日的摘要只查一次，再切出各視窗
+                    ticker, *_, days = partition
+                    day_dates, day_entries = self.build_day_table(ticker, days, stored_summaries)
+                    samples = builder.samples(partition, day_dates, day_entries, log_dates=True)
+                yield from samples or []
+                outer_bar.update(1)
@@ -0,0 +1,56 @@
+import os
+import json
+import hashlib
+import pandas as pd
+
+
+def fingerprint(config):
+    """Stable short hash of a JSON-serializable build configuration."""
+    payload = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class DatasetCache:
+    """Built sample tables stored as `<cache_dir>/<fingerprint>.parquet`.
+
+    A `<fingerprint>.json` sidecar records the configuration the table was
+    built from, so a cached split can be traced back to its inputs.
+    """
+
+    def __init__(self, cache_dir, logger):
+        self.cache_dir = cache_dir
+        self.logger = logger
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def load(self, key):
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            return pd.read_parquet(path)
+        except Exception as e:
+            # 缺少 parquet 套件，或檔案在其他機器寫到一半中斷而損毀：重建即可
+            self.logger.warning(f"Cannot read cached dataset {path}, rebuilding it: {e!r}")
+            return None
+
+    def save(self, key, config, data):
+        path = self.get_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            data.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        except ImportError as e:
+            self.logger.warning(f"Dataset cache needs pyarrow or fastparquet, not saving: {e}")
+            return None
+        except Exception as e:
+            self.logger.warning(f"Cannot save dataset cache {path}: {e!r}")
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with open(os.path.join(self.cache_dir, f"{key}.json"), 'w') as f:
+            json.dump(config, f, indent=4, default=str)
+        return path
@@ -0,0 +1,19 @@
+# Dataset locations; kept free of heavy imports so tools such as
+# precompute_summaries.py can resolve paths without loading torch
+BASE_PATH = "/home/pohsien0915/Research/datasets"
+
+# Dataset path mapping
+DATASET_PATHS = {
+    "ACL18": {
+        "price": "ACL18/stocknet-dataset/price",
+        "tweet": "ACL18/stocknet-dataset/tweet"
+    },
+    "CMIN": {
+        "price": "CMIN/CMIN-Dataset/CMIN-US/price",
+        "tweet": "CMIN/CMIN-Dataset/CMIN-US/news"
+    },
+    "SEP": {
+        "price": "SEP/sn2/price",
+        "tweet": "SEP/sn2/tweet"
+    }
+}
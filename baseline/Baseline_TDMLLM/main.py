@@ -7,22 +7,9 @@ import numpy as np
 import random
 
 from tdmllm.tdmllm import TDMLLM
-
-# Dataset path mapping
-DATASET_PATHS = {
-    "ACL18": {
-        "price": "ACL18/stocknet-dataset/price",
-        "tweet": "ACL18/stocknet-dataset/tweet"
-    },
-    "CMIN": {
-        "price": "CMIN/CMIN-Dataset/CMIN-US/price",
-        "tweet": "CMIN/CMIN-Dataset/CMIN-US/news"
-    },
-    "SEP": {
-        "price": "SEP/sn2/price",
-        "tweet": "SEP/sn2/tweet"
-    }
-}
+from dataloader.relevance_filter import DEFAULT_RELEVANCE_MODEL
+from models.registry import DEVICE_CHOICES, DTYPE_CHOICES, QUANTIZATION_CHOICES, resolve_device
+from dataloader.dataset_paths import BASE_PATH, DATASET_PATHS
 
 def setup_logger(to_terminal=False):
     log_filename = f"./log/exp_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
@@ -48,19 +35,47 @@ def set_random_seed(seed):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--base_model', type=str, default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument('--quantization', type=str, default="none", choices=QUANTIZATION_CHOICES, help="Weight quantization of the shared base model (8bit/4bit: bitsandbytes on GPU, int8_dynamic: int8 linear layers on CPU)")
+    parser.add_argument('--dtype', type=str, default="float16", choices=DTYPE_CHOICES)
+    parser.add_argument('--device', type=str, default="auto", choices=DEVICE_CHOICES, help="auto: spread over the visible GPUs, cpu: CPU-only nodes (needs --dtype bfloat16 or float32)")
+    parser.add_argument('--cpu_threads', type=int, default=0, help="torch threads of a CPU model (0 = every core this process may use)")
+    parser.add_argument('--draft_model', type=str, default="", help="Small model with the same tokenizer that drafts tokens for the base model to verify (speculative decoding, one prompt per generate call, e.g. meta-llama/Llama-3.2-1B-Instruct)")
+    parser.add_argument('--llm_server', type=str, default="", help="URL of a `python -m models.llm_server` daemon to generate with instead of loading the model (e.g. http://127.0.0.1:8765)")
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--out', type=str, default='')
     # Load data paths
     parser.add_argument("--dataset_name", type=str, default="ACL18", choices=["ACL18", "CMIN", "SEP"], help="Name of the dataset for saving results (ACL18, CMIN, or SEP)")
     parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--prefix_cache", action="store_true", help="Prefill the token prefix shared by a batch's prompts once and reuse its KV cache")
+    parser.add_argument("--max_batch_tokens", type=int, default=0, help="Cap a generation batch at this many tokens, rows x (longest prompt + max_new_tokens) (0 = only --batch_size)")
     parser.add_argument("--seq_len", type=int, default=5)
+    parser.add_argument("--price_cache_dir", type=str, default="", help="Directory for compiled price files (default: <price>/compiled/)")
+    parser.add_argument("--no_price_cache", action="store_true", help="Parse the text price files on every run")
+    parser.add_argument("--summaries_only_from_cache", action="store_true", help="Never load the summarizer model; days without a stored summary are skipped")
+    parser.add_argument("--strict_summary_cache", action="store_true", help="Like --summaries_only_from_cache, but fail on the first missing summary")
+    parser.add_argument("--dataset_cache_dir", type=str, default="", help="Where built datasets are cached by configuration fingerprint (default: <tweet>/datasets/)")
+    parser.add_argument("--no_dataset_cache", action="store_true", help="Always rebuild the dataset")
+    parser.add_argument("--tweet_filter", action="store_true", help="Drop duplicate, near-duplicate and spam tweets before summarizing")
+    parser.add_argument("--relevance_top_k", type=int, default=0, help="Keep only the k tweets/news of a day most similar to the ticker (sentence-transformers on CPU; 0 = off)")
+    parser.add_argument("--relevance_model", type=str, default=DEFAULT_RELEVANCE_MODEL)
+    parser.add_argument("--embedding_cache_dir", type=str, default="", help="On-disk embedding cache of the relevance filter (default: <tweet>/embeddings/)")
+    parser.add_argument("--max_prompt_tokens", type=int, default=0, help="Drop tweets / oldest summary days so summarize and predict prompts stay within this many tokens (0 = no limit)")
+    parser.add_argument("--summary_chunk_tokens", type=int, default=0, help="Summarize days whose tweets exceed this many tokens in chunks and merge the chunk summaries (0 = never)")
+    parser.add_argument("--revalidate_summaries", action="store_true", help="Re-hash every day's prompt instead of trusting stored summaries by date, so edited tweet files are re-summarized")
+    parser.add_argument("--prefetch_samples", type=int, default=0, help="Build test samples in a background thread, up to this many ahead of prediction (0 = build the whole split first)")
+    parser.add_argument("--load_workers", type=int, default=1, help="Processes that build ticker partitions of the dataset from stored summaries")
+    parser.add_argument("--packed_tweet_dir", type=str, default="", help="Corpus built by `python -m dataloader.tweet_store` (default: <tweet>/packed/, used if present)")
     args = parser.parse_args()
+    # 裝置與精度的組合在載入模型前就檢查，不必等資料集建完才失敗
+    try:
+        resolve_device(args.device, args.dtype, args.quantization)
+    except ValueError as e:
+        parser.error(str(e))
 
     # Set data paths based on dataset name
-    base_path = "/home/pohsien0915/Research/datasets"
     dataset_paths = DATASET_PATHS[args.dataset_name]
-    args.price_dir = f"{base_path}/{dataset_paths['price']}/preprocessed/"
-    args.tweet_dir = f"{base_path}/{dataset_paths['tweet']}/raw/"
+    args.price_dir = f"{BASE_PATH}/{dataset_paths['price']}/preprocessed/"
+    args.tweet_dir = f"{BASE_PATH}/{dataset_paths['tweet']}/raw/"
 
     # Setup logger
     logger = setup_logger()
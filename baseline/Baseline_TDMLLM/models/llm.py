@@ -1,62 +1,302 @@
 import time
+import json
+import threading
+import urllib.error
+import urllib.request
 import torch
-from transformers import (
-    LlamaForCausalLM, 
-    AutoTokenizer,
-    pipeline
-)
+from transformers import AutoTokenizer
+
+from models.registry import generate_lock, get_model, resolve_device
+from models.prefix_cache import PrefixCache, group_by_prefix
+from utils.generation_stats import GENERATION_STATS
+
+# Sampling settings of every generation; also part of the summary cache key
+GENERATION_KWARGS = {"max_new_tokens": 1024, "do_sample": True}
+# Response of a prompt whose batch failed; never a result worth storing
+INFERENCE_ERROR = "Inference Error"
+
+
+def length_buckets(lengths, batch_size, max_batch_tokens=0, new_tokens=0):
+    """Group prompt indices into batches of similar length, longest batch first.
+
+    A batch holds at most `batch_size` prompts and, when `max_batch_tokens`
+    is set, at most that many tokens counted as rows x (longest prompt +
+    `new_tokens`); a prompt over the budget on its own gets its own batch.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    for i in order:
+        if batches:
+            batch = batches[-1]
+            # 依長度遞減排序，批次中第一個就是最長的，決定整批的填充寬度
+            width = lengths[batch[0]] + new_tokens
+            if len(batch) < batch_size and (max_batch_tokens <= 0 or (len(batch) + 1) * width <= max_batch_tokens):
+                batch.append(i)
+                continue
+        batches.append([i])
+    return batches
+
+
+class FirstTokenTimer:
+    """generate() streamer that notes when the first new token comes out, i.e. when prefill ends."""
+
+    def __init__(self):
+        self.puts = 0
+        self.first_token_time = None
+
+    def put(self, value):
+        # 第一次 put 是 prompt 本身，第二次才是第一個生成的 token
+        self.puts += 1
+        if self.puts == 2:
+            self.first_token_time = time.perf_counter()
+
+    def end(self):
+        pass
+
+
+class ForwardCounter:
+    """Counts the forward passes a module makes for the current thread while the context is open (none if `module` is None)."""
+
+    def __init__(self, module):
+        self.module = module
+        self.calls = 0
+        # 模型由摘要預取執行緒與主執行緒共用，只計算本執行緒的 forward
+        self.thread = threading.get_ident()
+
+    def _count(self, module, inputs, output):
+        if threading.get_ident() == self.thread:
+            self.calls += 1
+
+    def __enter__(self):
+        self.handle = self.module.register_forward_hook(self._count) if self.module is not None else None
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.handle is not None:
+            self.handle.remove()
 
 
 class LLaMALLM:
-    def __init__(self, args, logger):
+    def __init__(self, args, logger, generation_kwargs=None):
         self.args = args
         self.logger = logger
 
-        # Load Tokenizer and Model
-        self.logger.info("📥 Load Tokenizer and Model...")
-        self.tokenizer = AutoTokenizer.from_pretrained(args.base_model)
-        # Set PAD Token
-        PAD_TOKEN = "<|pad|>"
-        self.tokenizer.add_special_tokens({"pad_token": PAD_TOKEN})
-        self.tokenizer.padding_side = "right"
-        
-        self.model = LlamaForCausalLM.from_pretrained(
-            args.base_model, 
-            torch_dtype=torch.float16,
-            device_map="auto"
+        # Load Tokenizer and Model (shared by every LLaMALLM of the process)
+        self.tokenizer, self.model = get_model(
+            args.base_model, args.dtype, args.quantization, args.device, args.cpu_threads, logger=logger
         )
         
-        self.logger.info("🧠 Set Text Generation Pipeline...")
-        self.text_gen_pipeline = pipeline(
-            task="text-generation",
-            batch_size=args.batch_size,
-            model=self.model,
-            tokenizer=self.tokenizer,
-            max_new_tokens=1024,
-            return_full_text=False,
-            do_sample=True
-        )
+        self.generation_kwargs = GENERATION_KWARGS if generation_kwargs is None else generation_kwargs
+        # 共用前綴（系統提示、指示與範例）只 prefill 一次
+        self.prefix_cache = PrefixCache(self.model) if args.prefix_cache else None
+
+        # Speculative decoding: a small model with the same tokenizer drafts tokens that the base model verifies
+        self.draft_model = None
+        if args.draft_model:
+            _, self.draft_model = get_model(
+                args.draft_model, args.dtype, "int8_dynamic" if args.quantization == "int8_dynamic" else "none",
+                resolve_device(args.device, args.dtype, args.quantization), args.cpu_threads, logger=logger
+            )
+            if self.prefix_cache is not None:
+                # 草稿模型沒有前綴的 cache，兩者不能併用
+                self.logger.warning("⚠️ --prefix_cache is ignored under --draft_model")
+                self.prefix_cache = None
 
     def create_chat_format_data(self, system_prompt, user_prompt):
         return [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
 
-    def __call__(self, system_prompt, user_prompt):
-        chat_format_data = self.create_chat_format_data(system_prompt, user_prompt)
+    def tokenize(self, system_prompt, user_prompt):
+        """Token ids of the chat-formatted prompt; the only time a prompt is tokenized."""
+        return tuple(self.tokenizer.apply_chat_template(
+            self.create_chat_format_data(system_prompt, user_prompt), tokenize=True, add_generation_prompt=True
+        ))
+
+    def __call__(self, system_prompt, user_prompt, stage="generate"):
+        return self.generate_batch([(system_prompt, user_prompt)], stage)[0]
+
+    def generate_batch(self, prompts, stage="generate"):
+        """Generate for a list of (system_prompt, user_prompt) pairs, returning the responses in input order.
 
-        prompt = self.tokenizer.apply_chat_template(
-            chat_format_data, tokenize=False, add_generation_prompt=True
+        Prompts are tokenized once, left-padded and grouped by token length
+        (see `length_buckets`) into batches of at most `args.batch_size`
+        prompts and `args.max_batch_tokens` tokens, so little compute goes to
+        padding. Under `--prefix_cache` prompts are first grouped by shared
+        prefix, whose KV cache is reused. Every model.generate call is
+        recorded in GENERATION_STATS under `stage`. Under `--draft_model`
+        prompts are generated one at a time, as assisted generation does
+        not batch.
+        """
+        rows = [self.tokenize(system_prompt, user_prompt) for system_prompt, user_prompt in prompts]
+        if not rows:
+            return []
+
+        responses = [None] * len(rows)
+        records = []
+        batch_size = 1 if self.draft_model is not None else self.args.batch_size
+        start_time = time.time()
+        for prefix, members in self._prefix_groups(rows):
+            batches = length_buckets(
+                [len(rows[i]) for i in members], batch_size, self.args.max_batch_tokens,
+                self.generation_kwargs.get("max_new_tokens", 0)
+            )
+            for batch in batches:
+                batch = [members[j] for j in batch]
+                try:
+                    outputs, record = self._generate_ids([rows[i] for i in batch], prefix, stage)
+                    records.append(record)
+                except Exception as e:
+                    # 只有這一批失敗，其他批次照常生成
+                    self.logger.exception("🔥 Batch inference failed!")
+                    outputs = [INFERENCE_ERROR] * len(batch)
+                for i, output in zip(batch, outputs):
+                    responses[i] = output
+        end_time = time.time()
+
+        if self.draft_model is not None and records:
+            draft_tokens = sum(record["draft_tokens"] for record in records)
+            accepted_tokens = sum(record["accepted_tokens"] for record in records)
+            self.logger.info(
+                f"🎯 [{stage}] Draft tokens accepted: {accepted_tokens}/{draft_tokens} "
+                f"({accepted_tokens / draft_tokens if draft_tokens else 0.0:.1%}), "
+                f"{sum(record['generated_tokens'] for record in records)} tokens in {sum(record['target_forwards'] for record in records)} base model forwards"
+            )
+        self.logger.info(
+            f"⏱️ [{stage}] {len(rows)} prompts ({sum(map(len, rows))} tokens) in {len(records)} batches: "
+            f"{end_time - start_time:.2f} seconds, {sum(record['generated_tokens'] for record in records)} tokens generated, "
+            f"{sum(record['cached_prefix_tokens'] for record in records)} prompt tokens from the prefix cache\n"
+        )
+        return responses
+
+    def _prefix_groups(self, rows):
+        """(prefix, row indices) groups: all rows without prefix, or under --prefix_cache the rows sharing a prefix."""
+        if self.prefix_cache is None:
+            return [((), list(range(len(rows))))]
+        groups = []
+        for prefix_length, members in group_by_prefix(rows, self.prefix_cache.min_tokens):
+            if len(members) > 1:
+                prefix = rows[members[0]][:prefix_length]
+            else:
+                prefix = self.prefix_cache.lookup(rows[members[0]])
+            groups.append((prefix, members))
+        return groups
+
+    def _generate_ids(self, rows, prefix, stage):
+        pad = self.tokenizer.pad_token_id
+        n = len(prefix)
+        width = max(len(row) for row in rows) - n
+        # 填充放在前綴與後綴之間（沒有前綴時即為左填充）：每列的前綴位置相同才能共用同一份 cache，位置編號由 attention mask 推得
+        input_ids = [list(prefix) + [pad] * (width - len(row) + n) + list(row[n:]) for row in rows]
+        attention_mask = [[1] * n + [0] * (width - len(row) + n) + [1] * (len(row) - n) for row in rows]
+        draft_kwargs = {"assistant_model": self.draft_model} if self.draft_model is not None else {}
+
+        timer = FirstTokenTimer()
+        # 預取執行緒的摘要與主執行緒的預測共用同一個模型，generate 輪流執行（計時從取得鎖之後開始）
+        with generate_lock(self.model):
+            # 前綴 cache 的 prefill 也會呼叫模型，在鎖內進行但不計入時間
+            cache_kwargs = {"past_key_values": self.prefix_cache.copy_for(prefix, len(rows))} if n else {}
+            start_time = time.perf_counter()
+            with torch.no_grad(), ForwardCounter(self.model) as target_forwards, ForwardCounter(self.draft_model) as draft_forwards:
+                output_ids = self.model.generate(
+                    input_ids=torch.tensor(input_ids, device=self.model.device),
+                    attention_mask=torch.tensor(attention_mask, device=self.model.device),
+                    pad_token_id=pad,
+                    streamer=timer,
+                    **cache_kwargs,
+                    **draft_kwargs,
+                    **self.generation_kwargs
+                )
+            end_time = time.perf_counter()
+        first_token_time = timer.first_token_time or end_time
+
+        generated = output_ids[:, n + width:]
+        generated_tokens = int((generated != pad).sum())
+        draft_stats = {}
+        if self.draft_model is not None:
+            # 每次驗證是一次 base model forward，產出被接受的草稿 token 再加一個 base model 自己的 token；
+            # 草稿模型每次 forward 提出一個 token
+            draft_stats = {
+                "target_forwards": target_forwards.calls,
+                "draft_tokens": draft_forwards.calls,
+                "accepted_tokens": max(0, generated_tokens - target_forwards.calls)
+            }
+        record = GENERATION_STATS.record(
+            stage,
+            batch_size=len(rows),
+            prompt_tokens=sum(len(row) for row in rows),
+            padding_tokens=len(rows) * (n + width) - sum(len(row) for row in rows),
+            cached_prefix_tokens=n * len(rows),
+            generated_tokens=generated_tokens,
+            prefill_ms=(first_token_time - start_time) * 1000,
+            decode_ms=(end_time - first_token_time) * 1000,
+            latency_ms=(end_time - start_time) * 1000,
+            **draft_stats
+        )
+        return self.tokenizer.batch_decode(generated, skip_special_tokens=True), record
+
+
+class RemoteLLM:
+    """Client of a `models.llm_server` daemon with the interface of LLaMALLM.
+
+    Every request names the model, dtype, quantization and generation
+    settings of this process; the server refuses requests for a model it
+    does not run, so stored summaries keep the fingerprint of the settings
+    that actually produced them.
+    """
+
+    def __init__(self, args, logger, generation_kwargs=None):
+        self.args = args
+        self.logger = logger
+        self.url = args.llm_server.rstrip("/")
+        self.generation_kwargs = GENERATION_KWARGS if generation_kwargs is None else generation_kwargs
+        self._tokenizer = None
+        self.logger.info(f"🌐 Using inference server {self.url}")
+
+    @property
+    def tokenizer(self):
+        # 模型在伺服器上，本地只載入 tokenizer 供 prompt 預算使用
+        if self._tokenizer is None:
+            self._tokenizer = AutoTokenizer.from_pretrained(self.args.base_model)
+        return self._tokenizer
+
+    def __call__(self, system_prompt, user_prompt, stage="generate"):
+        return self.generate_batch([(system_prompt, user_prompt)], stage)[0]
+
+    def generate_batch(self, prompts, stage="generate"):
+        """Responses to (system_prompt, user_prompt) pairs, in input order, batched by the server."""
+        if not prompts:
+            return []
+        body = json.dumps({
+            "model": self.args.base_model,
+            "dtype": self.args.dtype,
+            "quantization": self.args.quantization,
+            "generation_kwargs": self.generation_kwargs,
+            "prompts": [list(prompt) for prompt in prompts]
+        }).encode("utf-8")
+        request = urllib.request.Request(
+            f"{self.url}/generate", data=body, headers={"Content-Type": "application/json"}
         )
-        tokenized_input = self.tokenizer(prompt, return_tensors="pt")
-        num_tokens = tokenized_input['input_ids'].shape[1]  
-        self.logger.info(f"🔢 Token count: {num_tokens}")
 
         start_time = time.time()
         try:
-            response = self.text_gen_pipeline(prompt)[0]['generated_text']
-        except Exception as e:
-            self.logger.exception("🔥 Inference failed!")
-            return "Inference Error"
+            with urllib.request.urlopen(request) as response:
+                responses = json.loads(response.read())["responses"]
+        except urllib.error.HTTPError as e:
+            message = e.read().decode("utf-8", errors="replace")
+            # 4xx 表示設定不符（例如伺服器跑的是別的模型），不能當成一般推論失敗
+            if e.code < 500:
+                raise RuntimeError(f"Inference server rejected the request: {message}") from e
+            self.logger.error(f"🔥 Inference server failed: {message}")
+            return [INFERENCE_ERROR] * len(prompts)
         end_time = time.time()
 
-        self.logger.info(f"⏱️ Inference time: {end_time - start_time:.2f} seconds\n")
-        return response
\ No newline at end of file
+        # 伺服器端的 token 與 prefill/decode 時間不回傳，這裡只記錄來回延遲
+        GENERATION_STATS.record(stage, batch_size=len(prompts), latency_ms=(end_time - start_time) * 1000, remote=True)
+        self.logger.info(f"⏱️ [{stage}] Remote inference of {len(prompts)} prompts: {end_time - start_time:.2f} seconds\n")
+        return responses
+
+
+def build_llm(args, logger):
+    """The `--llm_server` client if one is configured, else the model loaded in this process."""
+    if args.llm_server:
+        return RemoteLLM(args, logger)
+    return LLaMALLM(args, logger)
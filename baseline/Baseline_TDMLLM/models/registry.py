@@ -0,0 +1,120 @@
+# torch and transformers are imported where they are used, so that the
+# choices and resolve_device stay cheap to import (e.g. for precompute_summaries)
+import os
+import threading
+
+PAD_TOKEN = "<|pad|>"
+QUANTIZATION_CHOICES = ["none", "8bit", "4bit", "int8_dynamic"]
+DTYPE_CHOICES = ["float16", "bfloat16", "float32"]
+DEVICE_CHOICES = ["auto", "cpu"]
+
+_models = {}
+_lock = threading.Lock()
+_generate_locks = {}
+
+
+def _quantization_config(quantization):
+    import torch
+    from transformers import BitsAndBytesConfig
+
+    if quantization == "4bit":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4"
+        )
+    if quantization == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    return None
+
+
+def resolve_device(device, dtype, quantization):
+    """The device the model loads on: int8_dynamic implies the CPU; raises ValueError on settings that cannot run."""
+    if quantization == "int8_dynamic":
+        device = "cpu"
+    if device != "cpu":
+        return device
+    if quantization in ("8bit", "4bit"):
+        raise ValueError(f"--quantization {quantization} (bitsandbytes) needs a GPU; use int8_dynamic on the CPU")
+    if dtype == "float16":
+        raise ValueError("float16 is not usable on the CPU; pass --dtype bfloat16 or --dtype float32")
+    if quantization == "int8_dynamic" and dtype != "float32":
+        raise ValueError("int8_dynamic quantizes float32 linear layers; pass --dtype float32")
+    return device
+
+
+def set_cpu_threads(num_threads=0, logger=None):
+    """Size torch's intra-op thread pool to `num_threads`, by default the cores this process may run on."""
+    import torch
+
+    if num_threads <= 0:
+        # 依 CPU affinity 計算，precompute 的 worker 各自綁定不同的核心
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(num_threads)
+    if logger:
+        logger.info(f"🧵 Using {num_threads} CPU threads")
+
+
+def get_model(model_id, dtype="float16", quantization="none", device="auto", cpu_threads=0, logger=None):
+    """Shared (tokenizer, model) for (model_id, dtype, quantization, device), loaded once per process.
+
+    Every LLaMALLM of the process (summarizer and predictor) wraps the same
+    weights with its own generation settings. The tokenizer gets a pad token
+    and left padding for batched generation. On the CPU the model is loaded
+    in bfloat16/float32 without a device map, and under int8_dynamic its
+    linear layers are quantized to int8 with dynamically quantized
+    activations (torch.ao.quantization.quantize_dynamic).
+    """
+    import torch
+    from transformers import AutoTokenizer, LlamaForCausalLM
+
+    device = resolve_device(device, dtype, quantization)
+    key = (model_id, dtype, quantization, device)
+    # 摘要預取執行緒與主執行緒可能同時要求同一個模型
+    with _lock:
+        if key in _models:
+            if logger:
+                logger.info(f"♻️ Reusing loaded {model_id} ({dtype}, quantization={quantization}, device={device})")
+            return _models[key]
+
+        if logger:
+            logger.info(f"📥 Load Tokenizer and Model {model_id} ({dtype}, quantization={quantization}, device={device})...")
+        tokenizer = AutoTokenizer.from_pretrained(model_id)
+        # Set PAD Token
+        tokenizer.add_special_tokens({"pad_token": PAD_TOKEN})
+        # Decoder-only generation over a batch needs the padding before the prompt
+        tokenizer.padding_side = "left"
+
+        if device == "cpu":
+            set_cpu_threads(cpu_threads, logger)
+            model = LlamaForCausalLM.from_pretrained(
+                model_id,
+                torch_dtype=getattr(torch, dtype),
+                low_cpu_mem_usage=True
+            )
+        else:
+            model = LlamaForCausalLM.from_pretrained(
+                model_id,
+                torch_dtype=getattr(torch, dtype),
+                device_map="auto",
+                quantization_config=_quantization_config(quantization)
+            )
+        # The added pad token needs an embedding row once batches are actually padded
+        model.resize_token_embeddings(len(tokenizer))
+        if quantization == "int8_dynamic":
+            # resize 之後才量化：lm_head 也是 Linear，量化後無法再調整大小
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        _models[key] = (tokenizer, model)
+        _generate_locks[id(model)] = threading.Lock()
+        return _models[key]
+
+
+def generate_lock(model):
+    """Lock to hold around `generate` on a registry model.
+
+    The summarizer of the sample prefetch thread and the predictor of the
+    main thread share one model, and generate is not thread-safe; their
+    calls take turns, while tweet reading and prompt building still overlap.
+    """
+    return _generate_locks[id(model)]
@@ -0,0 +1,149 @@
+import json
+import time
+import logging
+import argparse
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+# models.llm 在匯入時就需要 torch；伺服器測試本身不載入任何權重
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from models import llm_server
+from models.llm import GENERATION_KWARGS, INFERENCE_ERROR, RemoteLLM
+
+
+class StubLLM:
+    """Stands in for LLaMALLM: answers each prompt with its user prompt and records every batch."""
+
+    batches = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def __init__(self, args, logger, generation_kwargs=None):
+        self.generation_kwargs = generation_kwargs
+
+    def generate_batch(self, prompts, stage="generate"):
+        StubLLM.batches.append([user_prompt for _, user_prompt in prompts])
+        if any(user_prompt == "block" for _, user_prompt in prompts):
+            # 讓後續請求在佇列中等待，才能併成下一批
+            StubLLM.started.set()
+            StubLLM.release.wait(10)
+        if any(user_prompt == "fail" for _, user_prompt in prompts):
+            raise RuntimeError("stub failure")
+        return [f"{self.generation_kwargs['max_new_tokens']}:{user_prompt}" for _, user_prompt in prompts]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    StubLLM.batches = []
+    StubLLM.started = threading.Event()
+    StubLLM.release = threading.Event()
+    monkeypatch.setattr(llm_server, "LLaMALLM", StubLLM)
+    args = argparse.Namespace(
+        base_model="stub-model", dtype="float32", quantization="none",
+        batch_size=8, max_wait_ms=0, host="127.0.0.1", port=0
+    )
+    server = llm_server.LLMServer(args, logging.getLogger(__name__))
+    server.scheduler.start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    StubLLM.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def client(server, base_model="stub-model", generation_kwargs=None):
+    args = argparse.Namespace(
+        llm_server=f"http://127.0.0.1:{server.server_address[1]}",
+        base_model=base_model, dtype="float32", quantization="none"
+    )
+    return RemoteLLM(args, logging.getLogger(__name__), generation_kwargs)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_responses_in_request_order(server):
+    responses = client(server).generate_batch([("sys", "a"), ("sys", "b"), ("sys", "c")])
+    assert responses == [f"{GENERATION_KWARGS['max_new_tokens']}:{prompt}" for prompt in "abc"]
+    assert StubLLM.batches == [["a", "b", "c"]]
+
+
+def test_queued_requests_share_a_batch(server):
+    blocker = threading.Thread(target=client(server).generate_batch, args=([("sys", "block")],))
+    blocker.start()
+    assert StubLLM.started.wait(10)
+
+    # 第一批生成期間送出的請求在佇列中等待
+    requests = [["r1-a", "r1-b"], ["r2-a"], ["r3-a", "r3-b", "r3-c"]]
+    results = {}
+
+    def send(prompts):
+        results[prompts[0]] = client(server).generate_batch([("sys", prompt) for prompt in prompts])
+
+    threads = [threading.Thread(target=send, args=(prompts,)) for prompts in requests]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: server.scheduler.queue.qsize() == len(requests))
+    StubLLM.release.set()
+    for thread in threads + [blocker]:
+        thread.join(10)
+
+    # 三個請求併成同一批，各自只拿回自己的回應
+    assert len(StubLLM.batches) == 2
+    assert sorted(StubLLM.batches[1]) == sorted(prompt for prompts in requests for prompt in prompts)
+    for prompts in requests:
+        assert results[prompts[0]] == [f"{GENERATION_KWARGS['max_new_tokens']}:{prompt}" for prompt in prompts]
+
+
+def test_generation_settings_are_batched_separately(server):
+    blocker = threading.Thread(target=client(server).generate_batch, args=([("sys", "block")],))
+    blocker.start()
+    assert StubLLM.started.wait(10)
+
+    results = {}
+    short = {**GENERATION_KWARGS, "max_new_tokens": 4}
+    threads = [
+        threading.Thread(target=lambda: results.setdefault("default", client(server).generate_batch([("sys", "x")]))),
+        threading.Thread(target=lambda: results.setdefault("short", client(server, generation_kwargs=short).generate_batch([("sys", "y")])))
+    ]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: server.scheduler.queue.qsize() == 2)
+    StubLLM.release.set()
+    for thread in threads + [blocker]:
+        thread.join(10)
+
+    assert sorted(StubLLM.batches[1:]) == [["x"], ["y"]]
+    assert results == {"default": [f"{GENERATION_KWARGS['max_new_tokens']}:x"], "short": ["4:y"]}
+
+
+def test_failed_batch_returns_inference_error(server):
+    assert client(server).generate_batch([("sys", "fail"), ("sys", "other")]) == [INFERENCE_ERROR, INFERENCE_ERROR]
+    # 失敗只影響該批，伺服器繼續服務
+    assert client(server).generate_batch([("sys", "ok")]) == [f"{GENERATION_KWARGS['max_new_tokens']}:ok"]
+
+
+def test_other_model_is_refused(server):
+    with pytest.raises(RuntimeError, match="rejected"):
+        client(server, base_model="other-model").generate_batch([("sys", "a")])
+    assert StubLLM.batches == []
+
+
+def test_malformed_request(server):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{server.server_address[1]}/generate",
+        data=json.dumps({"model": "stub-model", "prompts": ["not a pair"]}).encode("utf-8"),
+        headers={"Content-Type": "application/json"}
+    )
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request)
+    assert error.value.code == 400
@@ -0,0 +1,237 @@
+"""Populate `summaries/summaries.sqlite` for every (ticker, date) of a tweet tree.
+
+Work is split into `--num_shards` x `--workers` shards by a hash of the
+ticker-day. Each worker first summarizes its own shard and then steals the
+days of other shards that nobody holds (or whose claim went stale), so
+faster workers keep busy until the whole tree is done. Claims live in the
+summary store, so several machines sharing the dataset directory can run
+this at once, and a killed run resumes where it stopped: finished days are
+skipped and the claims of dead workers expire after `--claim_timeout`.
+
+    python precompute_summaries.py --dataset_name SEP --workers 2 --gpus 0,1
+    python precompute_summaries.py --dataset_name SEP --num_shards 2 --shard 1   # on a second machine
+    python precompute_summaries.py --dataset_name SEP --workers 4 --dtype float32 --quantization int8_dynamic   # CPU-only node
+"""
+import os
+import sys
+import socket
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from datetime import datetime
+
+from dataloader.dataset_paths import BASE_PATH, DATASET_PATHS
+from models.registry import DEVICE_CHOICES, DTYPE_CHOICES, QUANTIZATION_CHOICES, resolve_device
+from dataloader.tweet_store import PackedTweetReader, default_packed_tweet_dir, read_raw_tweets
+from dataloader.tweet_filter import filter_tweets
+from dataloader.relevance_filter import DEFAULT_RELEVANCE_MODEL, build_relevance_filter
+
+
+def worker_log_prefix(worker_name):
+    return f"./log/precompute_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{worker_name}"
+
+
+def setup_worker_logger(log_prefix, worker_name, to_terminal=False):
+    log_filename = f"{log_prefix}.log"
+
+    handlers = [logging.FileHandler(log_filename, encoding="utf-8")]
+
+    if to_terminal:
+        handlers.append(logging.StreamHandler(sys.stdout))
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s [%(levelname)s] [{worker_name}] %(message)s",
+        handlers=handlers
+    )
+    return logging.getLogger(__name__)
+
+
+def shard_of(ticker, date_str, num_shards):
+    digest = hashlib.md5(f"{ticker}/{date_str}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+class TweetSource:
+    """Enumerates and reads ticker-days from the packed corpus if present, else from the raw tree.
+
+    Tickers added or changed in the raw tree after packing are read raw.
+    """
+
+    def __init__(self, tweet_dir, packed_tweet_dir="", tweet_filter=False, relevance_filter=None):
+        self.tweet_dir = tweet_dir
+        self.tweet_filter = tweet_filter
+        self.relevance_filter = relevance_filter
+        self.reader = None
+        self.stale_tickers = set()
+        packed_tweet_dir = packed_tweet_dir or default_packed_tweet_dir(tweet_dir)
+        if PackedTweetReader.is_packed(packed_tweet_dir):
+            self.reader = PackedTweetReader(packed_tweet_dir)
+            self.stale_tickers = self.reader.stale_tickers(tweet_dir)
+
+    def raw_days(self, tickers):
+        days = []
+        for ticker in tickers:
+            ticker_dir = os.path.join(self.tweet_dir, ticker)
+            if os.path.isdir(ticker_dir):
+                days.extend((ticker, date_str) for date_str in sorted(os.listdir(ticker_dir)))
+        return days
+
+    def days(self):
+        if self.reader is None:
+            return self.raw_days(sorted(os.listdir(self.tweet_dir)))
+        days = [(ticker, date_str) for ticker in self.reader.tickers() if ticker not in self.stale_tickers
+                for date_str in self.reader.dates(ticker)]
+        return days + self.raw_days(sorted(self.stale_tickers))
+
+    def get_tweets(self, ticker, date_str):
+        if self.reader is not None and ticker not in self.stale_tickers:
+            tweets = self.reader.get_tweets(ticker, date_str)
+        else:
+            tweets = read_raw_tweets(os.path.join(self.tweet_dir, ticker, date_str))
+        # 與 DataLoader.get_tweets 相同的過濾，prompt 才會一致
+        if self.tweet_filter:
+            tweets = filter_tweets(tweets)
+        if self.relevance_filter is not None and tweets:
+            tweets = self.relevance_filter.filter(ticker, tweets)
+        return tweets
+
+
+def summarize_days(summarizer, source, days, owner, args, logger):
+    """Claim, summarize and release `days` one generation batch at a time; returns how many days were stored."""
+    store = summarizer.store
+    claim_size = max(1, args.batch_size)
+    done = 0
+    for start in range(0, len(days), claim_size):
+        batch = [(ticker, date_str) for ticker, date_str in days[start:start + claim_size]
+                 if store.load(ticker, date_str) is None]
+        if not batch:
+            continue
+        claimed = store.claim(batch, owner, args.claim_timeout)
+        if not claimed:
+            continue
+        try:
+            # 檢查與認領之間其他 worker 可能已存好摘要（例如接手了它過期的認領）
+            todo = [(ticker, date_str) for ticker, date_str in claimed if store.load(ticker, date_str) is None]
+            requests = [(ticker, date_str, source.get_tweets(ticker, date_str)) for ticker, date_str in todo]
+            # 分段摘要會產生多個批次，每批前更新認領時間，避免被當成已過期
+            summarizer.before_batch = lambda: store.refresh(claimed, owner)
+            summarizer.get_summaries(requests)
+            # 生成失敗的交易日不會存入，只計算實際存好的
+            stored = sum(store.load(ticker, date_str) is not None for ticker, date_str in todo)
+        finally:
+            summarizer.before_batch = None
+            store.release(claimed, owner)
+        done += stored
+        if stored < len(todo):
+            logger.warning(f"⚠️ {len(todo) - stored} ticker-days not stored, retried on the next run")
+        logger.info(f"✅ {done} ticker-days summarized ({min(start + claim_size, len(days))}/{len(days)} scanned)")
+    return done
+
+
+def split_cpus(workers):
+    """Disjoint sets of the cores this process may use, one per local worker."""
+    cpus = sorted(os.sched_getaffinity(0))
+    size = max(1, len(cpus) // workers)
+    return [set(cpus[i * size:(i + 1) * size] or cpus) for i in range(workers)]
+
+
+def run_worker(args, shard, num_shards, gpu=None, cpus=None):
+    # 每個 worker 只看得到分配給它的 GPU，須在載入模型前設定
+    if gpu is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu
+    # CPU 模型的 worker 各綁一組核心，執行緒數隨之而定，彼此不搶核心
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    from summarize_module.summarizer import Summarizer
+    from utils.generation_stats import GENERATION_STATS
+
+    worker_name = f"shard{shard}of{num_shards}"
+    log_prefix = worker_log_prefix(worker_name)
+    logger = setup_worker_logger(log_prefix, worker_name, to_terminal=args.verbose)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    summarizer = Summarizer(args, logger)
+    source = TweetSource(args.tweet_dir, args.packed_tweet_dir, args.tweet_filter, build_relevance_filter(args))
+
+    days = source.days()
+    own = [day for day in days if shard_of(*day, num_shards) == shard]
+    others = [day for day in days if shard_of(*day, num_shards) != shard]
+    if source.stale_tickers:
+        logger.warning(f"⚠️ {len(source.stale_tickers)} tickers changed since packing, read from {args.tweet_dir}")
+    logger.info(f"📂 {len(days)} ticker-days in {args.tweet_dir}, {len(own)} in this shard")
+
+    done = summarize_days(summarizer, source, own, owner, args, logger)
+    # 自己的分片完成後，接手其他分片尚未認領或認領已逾時的交易日
+    done += summarize_days(summarizer, source, others, owner, args, logger)
+    logger.info(f"🏁 Worker {owner} finished, {done} ticker-days summarized")
+    logger.info(f"📈 Generation stats: {GENERATION_STATS.save(f'{log_prefix}_generation_stats.json')}")
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute the daily summaries of a dataset")
+    parser.add_argument('--base_model', type=str, default="meta-llama/Meta-Llama-3.1-8B-Instruct")
+    parser.add_argument('--quantization', type=str, default="none", choices=QUANTIZATION_CHOICES, help="Weight quantization of the base model (8bit/4bit: bitsandbytes on GPU, int8_dynamic: int8 linear layers on CPU)")
+    parser.add_argument('--dtype', type=str, default="float16", choices=DTYPE_CHOICES)
+    parser.add_argument('--device', type=str, default="auto", choices=DEVICE_CHOICES, help="cpu: summarize on CPU-only nodes (needs --dtype bfloat16 or float32)")
+    parser.add_argument('--cpu_threads', type=int, default=0, help="torch threads per worker of a CPU model (0 = the worker's share of the cores)")
+    parser.add_argument('--draft_model', type=str, default="", help="Small model with the same tokenizer that drafts tokens for the base model to verify (speculative decoding, one prompt per generate call)")
+    parser.add_argument('--llm_server', type=str, default="", help="URL of a `python -m models.llm_server` daemon shared by all workers (e.g. http://127.0.0.1:8765)")
+    parser.add_argument("--dataset_name", type=str, default="ACL18", choices=["ACL18", "CMIN", "SEP"])
+    parser.add_argument("--tweet_dir", type=str, default="", help="Raw tweet tree (default: the dataset's tweet/raw/)")
+    parser.add_argument("--packed_tweet_dir", type=str, default="", help="Corpus built by `python -m dataloader.tweet_store` (default: <tweet>/packed/, used if present)")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--prefix_cache", action="store_true", help="Prefill the token prefix shared by a batch's prompts once and reuse its KV cache")
+    parser.add_argument("--max_batch_tokens", type=int, default=0, help="Cap a generation batch at this many tokens, rows x (longest prompt + max_new_tokens) (0 = only --batch_size)")
+    parser.add_argument("--summary_chunk_tokens", type=int, default=0, help="Summarize days whose tweets exceed this many tokens in chunks and merge the chunk summaries (0 = never)")
+    parser.add_argument("--max_prompt_tokens", type=int, default=0, help="Drop tweets so summarize prompts stay within this many tokens (0 = no limit)")
+    parser.add_argument("--tweet_filter", action="store_true", help="Drop duplicate, near-duplicate and spam tweets before summarizing")
+    parser.add_argument("--relevance_top_k", type=int, default=0, help="Keep only the k tweets/news of a day most similar to the ticker (sentence-transformers on CPU; 0 = off)")
+    parser.add_argument("--relevance_model", type=str, default=DEFAULT_RELEVANCE_MODEL)
+    parser.add_argument("--embedding_cache_dir", type=str, default="", help="On-disk embedding cache of the relevance filter (default: <tweet>/embeddings/)")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes on this machine")
+    parser.add_argument("--gpus", type=str, default="", help="Comma-separated GPU ids assigned to the local workers round-robin")
+    parser.add_argument("--num_shards", type=int, default=1, help="Number of machines sharing the work")
+    parser.add_argument("--shard", type=int, default=0, help="Index of this machine among --num_shards")
+    parser.add_argument("--claim_timeout", type=float, default=1800, help="Seconds after which another worker's claim on a day is considered dead")
+    parser.add_argument("--verbose", action="store_true", help="Also log to the terminal")
+    args = parser.parse_args()
+    try:
+        device = resolve_device(args.device, args.dtype, args.quantization)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if not args.tweet_dir:
+        args.tweet_dir = f"{BASE_PATH}/{DATASET_PATHS[args.dataset_name]['tweet']}/raw/"
+    # Summarizer 的快取模式在此無意義：目的就是產生缺少的摘要
+    args.summaries_only_from_cache = False
+    args.strict_summary_cache = False
+
+    os.makedirs("./log", exist_ok=True)
+    num_shards = args.num_shards * args.workers
+    shards = [args.shard * args.workers + i for i in range(args.workers)]
+    gpus = [gpu for gpu in args.gpus.split(",") if gpu]
+    if args.workers == 1:
+        run_worker(args, shards[0], num_shards, gpus[0] if gpus else None)
+        return
+    # 模型在 CPU 上時（且未經 --llm_server），各 worker 分到不同的核心
+    cpus = split_cpus(args.workers) if device == "cpu" and not args.llm_server else [None] * args.workers
+
+    # spawn：子行程各自初始化 CUDA
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(args, shard, num_shards, gpus[i % len(gpus)] if gpus else None, cpus[i]))
+        for i, shard in enumerate(shards)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [process.pid for process in processes if process.exitcode != 0]
+    if failed:
+        sys.exit(f"Workers {failed} failed; rerun to resume")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,100 +1,306 @@
-import re
-import os
-import json
 from pathlib import Path
 
-from models.llm import LLaMALLM
-from utils.prompts import NEWS_SUMMARY_INSTRUCTION
+from transformers import AutoTokenizer
+
+from dataloader.tweet_filter import FILTER_VERSION
+from dataloader.tweet_store import TweetFileStates, default_packed_tweet_dir
+from models.llm import GENERATION_KWARGS, INFERENCE_ERROR, build_llm
+from summarize_module.summary_store import SummaryStore, is_informative
+from utils.prompts import NEWS_SUMMARY_INSTRUCTION, NEWS_SUMMARY_REDUCE_INSTRUCTION
+from utils.prompt_budget import PromptBudget
 
 class Summarizer:
     def __init__(self, args, logger, method_name="TDMLLM"):
+        self.args = args
         self.logger = logger
         self.summarize_prompt = NEWS_SUMMARY_INSTRUCTION
-        self.llm = LLaMALLM(args, logger)
+        self.reduce_prompt = NEWS_SUMMARY_REDUCE_INSTRUCTION
+        # 推文 token 數超過此上限的交易日改為分段摘要再合併 (0 表示不分段)
+        self.chunk_tokens = args.summary_chunk_tokens
+        self._llm = None
+        self._tokenizer = None
+        self.max_prompt_tokens = args.max_prompt_tokens
+        self._prompt_budget = None
         self.method_name = method_name
+        # 只使用已存在的摘要：strict 模式遇到缺漏直接報錯，否則略過該日
+        self.strict_cache = args.strict_summary_cache
+        self.cache_only = args.summaries_only_from_cache or self.strict_cache
+        # 沒有摘要的交易日數（cache-only 模式略過或生成失敗）；有缺漏時建好的資料集不寫入快取
+        self.skipped_days = 0
+        # 每個生成批次前呼叫（precompute 用來更新認領時間）
+        self.before_batch = None
         
         # Initialize paths for summary storage
         tweet_dir = Path(args.tweet_dir)
         self.dataset_root = tweet_dir.parent
         self.summaries_dir = self.dataset_root / "summaries"
-        self.summaries_dir.mkdir(exist_ok=True)
         
-        # Get model name for the summary file
+        # Get model name for the summary store
         self.model_name = Path(args.base_model).name
-        self.model_dir = self.summaries_dir / self.model_name
-        self.model_dir.mkdir(exist_ok=True)
         
-        # Create method-specific directory
-        self.method_dir = self.model_dir / self.method_name
-        self.method_dir.mkdir(exist_ok=True)
+        # 會改變 prompt 內容的設定都併入指紋：摘要模板、分段合併、推文過濾
+        prompt_template = self.summarize_prompt
+        if self.chunk_tokens > 0:
+            prompt_template += f"{self.reduce_prompt}{self.chunk_tokens}"
+        if args.tweet_filter:
+            prompt_template += f"tweet_filter{FILTER_VERSION}"
+        if args.relevance_top_k > 0:
+            prompt_template += f"relevance{args.relevance_model}{args.relevance_top_k}"
+        if self.max_prompt_tokens > 0:
+            prompt_template += f"max_prompt_tokens{self.max_prompt_tokens}"
+
+        generation_config = {"model": args.base_model, **GENERATION_KWARGS}
+        # 量化或其他精度的權重產生的摘要不同，不與 float16 的摘要混用
+        # （--draft_model 不改變 base model 的輸出分佈，不列入）
+        if args.quantization != "none":
+            generation_config["quantization"] = args.quantization
+        if args.dtype != "float16":
+            generation_config["dtype"] = args.dtype
+
+        # Summaries of all models/methods share one SQLite file
+        self.store = SummaryStore(
+            self.summaries_dir, self.model_name, self.method_name,
+            generation_config=generation_config,
+            prompt_template=prompt_template,
+            logger=logger,
+            tweet_states=TweetFileStates(args.tweet_dir, args.packed_tweet_dir or default_packed_tweet_dir(args.tweet_dir))
+        )
         
         self.logger.info(f"Summary directory: {self.summaries_dir}")
-        self.logger.info(f"Model directory: {self.model_dir}")
-        self.logger.info(f"Method directory: {self.method_dir}")
+        self.logger.info(f"Summary store: {self.store.db_path}")
         self.logger.info(f"Using model: {self.model_name}")
         self.logger.info(f"Using method: {self.method_name}")
 
-    def get_summary_path(self, ticker, date):
-        """Get the path for a summary file."""
-        ticker_dir = self.method_dir / ticker
-        ticker_dir.mkdir(exist_ok=True)
-        return ticker_dir / f"{date}.json"
+    @property
+    def llm(self):
+        """The summarization model, loaded on the first cache miss."""
+        if self._llm is None:
+            self.logger.info("Loading summarizer model for uncached summaries")
+            self._llm = build_llm(self.args, self.logger)
+        return self._llm
+
+    @property
+    def tokenizer(self):
+        """Tokenizer used to measure tweet chunks; loading it does not load the model."""
+        if self._tokenizer is None:
+            if self._llm is not None:
+                self._tokenizer = self._llm.tokenizer
+            else:
+                self._tokenizer = AutoTokenizer.from_pretrained(self.args.base_model)
+        return self._tokenizer
+
+    @property
+    def prompt_budget(self):
+        if self._prompt_budget is None:
+            self._prompt_budget = PromptBudget(self.tokenizer, self.max_prompt_tokens)
+        return self._prompt_budget
 
     def load_existing_summary(self, ticker, date):
         """Load an existing summary if it exists."""
-        summary_path = self.get_summary_path(ticker, date)
-        if summary_path.exists():
-            try:
-                with open(summary_path, 'r') as f:
-                    return json.load(f)
-            except json.JSONDecodeError as e:
-                self.logger.error(f"Error loading summary for {ticker} on {date}: {e}")
-                return None
-        return None
+        return self.store.load(ticker, date)
 
     def save_summary(self, ticker, date, tweet_data, prompt, summary):
-        """Save a summary to file."""
-        data = {
-            "ticker": ticker,
-            "date": date,
-            "tweet_data": tweet_data,
-            "prompt": prompt,
-            "summary": summary,
-            "model": self.model_name,
-            "method": self.method_name
-        }
-        
-        summary_path = self.get_summary_path(ticker, date)
+        """Save a summary to the store."""
+        self.save_summaries([(ticker, date, tweet_data, prompt, summary)])
+
+    def save_summaries(self, records):
+        """Save (ticker, date, tweet_data, prompt, summary) records in one transaction."""
         try:
-            with open(summary_path, 'w') as f:
-                json.dump(data, f, indent=4)
-            self.logger.info(f"Saved summary for {ticker} on {date}")
+            self.store.save_many(records)
+            self.logger.info(f"Saved {len(records)} summaries")
         except Exception as e:
-            self.logger.error(f"Error saving summary for {ticker} on {date}: {e}")
+            self.logger.error(f"Error saving {len(records)} summaries: {e}")
+
+    def build_prompt(self, ticker, tweets):
+        def render(kept):
+            return self.summarize_prompt.format(ticker=ticker, news=kept)
+
+        if self.max_prompt_tokens <= 0:
+            return render(tweets)
+        # 超過 --max_prompt_tokens 時保留前面的推文
+        prompt, kept = self.prompt_budget.fit(render, tweets, keep="head")
+        if len(kept) < len(tweets):
+            self.logger.info(f"✂️ Kept {len(kept)} of {len(tweets)} tweets within {self.max_prompt_tokens} tokens")
+        return prompt
 
     def get_summary(self, ticker, date_str, tweets):
-        # First check if summary already exists
-        existing_summary = self.load_existing_summary(ticker, date_str)
-        if existing_summary:
-            self.logger.info(f"Found existing summary for {ticker} on {date_str}")
-            return existing_summary["summary"]
-
-        # If no existing summary, generate new one
-        summary = None
-        prompt = ""
-        if tweets:
-            prompt = self.summarize_prompt.format(ticker=ticker, news=tweets)
-            summary = self.llm("", prompt)
-
-        self.logger.info(f"\n📌 Summary for {ticker} on {date_str}")
-        self.logger.info(f"🗞️ Tweet count: {len(tweets)}")
-        self.logger.info(f"🧾 Summary: {summary}")
-
-        # Save the new summary
-        self.save_summary(ticker, date_str, tweets, prompt, summary)
-
-        return summary
+        return self.get_summaries([(ticker, date_str, tweets)])[0]
+
+    def find_stored_summary(self, ticker, date_str, prompt, key):
+        """Stored summary for a rendered prompt, as (summary,), or None.
+
+        Looks the prompt up by content key first, so a ticker-day with the
+        same prompt as one already summarized (e.g. cross-posted news) reuses
+        it. A ticker-day indexed under an older fingerprint is reused only if
+        its stored prompt is exactly the prompt rendered now.
+        """
+        content = self.store.get_content(key)
+        if content is not None:
+            return (content[0],)
+        indexed = self.store.load_indexed(ticker, date_str)
+        if indexed is not None and indexed[1] == prompt:
+            return (indexed[0],)
+        return None
+
+    def can_generate(self, ticker, date_str):
+        """Whether a missing summary may be generated; raises under --strict_summary_cache."""
+        if self.strict_cache:
+            raise RuntimeError(f"No stored summary for {ticker} on {date_str} (--strict_summary_cache)")
+        if self.cache_only:
+            self.logger.warning(f"⏭️ Skipping uncached summary for {ticker} on {date_str}")
+            self.skipped_days += 1
+            return False
+        return True
+
+    def generate_pending(self, pending, stage="summary"):
+        """Generate {key: (prompt, targets)} prompts, shortest first, `args.batch_size` at a time.
+
+        Yields each batch of (prompt, targets) with its outputs; sorting by
+        length keeps the padding of every batch small.
+        """
+        pending = sorted(pending.values(), key=lambda item: len(item[0]))
+        batch_size = max(1, self.args.batch_size)
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            if self.before_batch is not None:
+                self.before_batch()
+            yield batch, self.llm.generate_batch([("", prompt) for prompt, _ in batch], stage)
+
+    def split_tweets(self, tweets):
+        """Split a day's tweets into consecutive chunks of at most `--summary_chunk_tokens` tokens.
+
+        Chunks are filled greedily in tweet order, so tweets appended to a day
+        leave its earlier chunks, and their cached summaries, unchanged. A
+        tweet longer than the budget forms a chunk of its own.
+        """
+        chunks, chunk, chunk_tokens = [], [], 0
+        for tweet in tweets:
+            num_tokens = self.prompt_budget.count(tweet)
+            if chunk and chunk_tokens + num_tokens > self.chunk_tokens:
+                chunks.append(chunk)
+                chunk, chunk_tokens = [], 0
+            chunk.append(tweet)
+            chunk_tokens += num_tokens
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def build_reduce_prompt(self, ticker, chunk_summaries):
+        parts = "\n\n".join(f"Part {n}:\n{summary}" for n, summary in enumerate(chunk_summaries, 1))
+        return self.reduce_prompt.format(ticker=ticker, summaries=parts)
+
+    def summarize_chunks(self, requests, chunk_prompts):
+        """Map step: summaries of every chunk prompt, as {request index: [chunk summary]}.
+
+        Chunk summaries are stored by content key only, so they are shared by
+        any day whose tweets produce the same chunk. A day with a chunk that
+        cannot be generated (cache-only modes) is left out.
+        """
+        chunk_summaries = {}
+        pending = {}
+        for i, prompts in chunk_prompts.items():
+            ticker, date_str, _ = requests[i]
+            chunk_summaries[i] = [None] * len(prompts)
+            for j, prompt in enumerate(prompts):
+                key = self.store.content_key(prompt)
+                content = self.store.get_content(key)
+                if content is not None:
+                    chunk_summaries[i][j] = content[0]
+                elif key in pending:
+                    pending[key][1].append((i, j))
+                elif self.can_generate(ticker, date_str):
+                    pending[key] = (prompt, [(i, j)])
+                else:
+                    del chunk_summaries[i]
+                    break
+
+        if pending:
+            self.logger.info(f"🧩 Summarizing {len(pending)} tweet chunks")
+        for batch, outputs in self.generate_pending(pending, "summary_chunk"):
+            for (_, targets), summary in zip(batch, outputs):
+                for i, j in targets:
+                    if summary == INFERENCE_ERROR:
+                        # 分段生成失敗的交易日不合併，下次執行再重試
+                        if chunk_summaries.pop(i, None) is not None:
+                            self.skipped_days += 1
+                    elif i in chunk_summaries:
+                        chunk_summaries[i][j] = summary
+            self.store.save_contents([
+                (prompt, summary) for (prompt, _), summary in zip(batch, outputs) if summary != INFERENCE_ERROR
+            ])
+        return chunk_summaries
+
+    def get_summaries(self, requests):
+        """Summaries for a list of (ticker, date_str, tweets) requests, in request order.
+
+        Summaries are cached by a hash of (model, generation settings, rendered
+        prompt): a changed instruction, example block or tweet file yields a
+        new key and is regenerated, and identical prompts are generated once.
+        The remaining prompts are sorted by length and generated
+        `args.batch_size` at a time, so each batch pads as little as possible.
+
+        With `--summary_chunk_tokens`, a day whose tweets exceed the budget is
+        summarized map-reduce style: its chunks are summarized in batches and
+        the chunk summaries are then merged by one reduce prompt.
+        """
+        summaries = [None] * len(requests)
+        prompts = {}
+        chunk_prompts = {}
+        records = []
+        for i, (ticker, date_str, tweets) in enumerate(requests):
+            if not tweets:
+                # Days without tweets are stored as empty so they are not looked up again
+                records.append((ticker, date_str, tweets, "", None))
+                continue
+            chunks = self.split_tweets(tweets) if self.chunk_tokens > 0 else [tweets]
+            if len(chunks) > 1:
+                chunk_prompts[i] = [self.build_prompt(ticker, chunk) for chunk in chunks]
+            else:
+                prompts[i] = self.build_prompt(ticker, tweets)
+
+        if chunk_prompts:
+            for i, chunk_summaries in self.summarize_chunks(requests, chunk_prompts).items():
+                prompts[i] = self.build_reduce_prompt(requests[i][0], chunk_summaries)
+
+        pending = {}
+        for i, prompt in sorted(prompts.items()):
+            ticker, date_str, tweets = requests[i]
+            key = self.store.content_key(prompt)
+            stored = self.find_stored_summary(ticker, date_str, prompt, key)
+            if stored is not None:
+                self.logger.info(f"Found existing summary for {ticker} on {date_str}")
+                summaries[i] = stored[0]
+                records.append((ticker, date_str, tweets, prompt, stored[0]))
+            elif key in pending:
+                pending[key][1].append(i)
+            elif self.can_generate(ticker, date_str):
+                pending[key] = (prompt, [i])
+
+        # (Re)index the summaries found above under the current fingerprint
+        if records:
+            self.save_summaries(records)
+
+        # If no existing summary, generate new ones
+        for batch, outputs in self.generate_pending(pending):
+            records = []
+            for (prompt, indices), summary in zip(batch, outputs):
+                if summary == INFERENCE_ERROR:
+                    # 不存入摘要庫，否則失敗會被當成該日永久的摘要
+                    self.logger.warning(f"⚠️ Summary generation failed for {len(indices)} ticker-days, retried on the next run")
+                    self.skipped_days += len(indices)
+                    continue
+                for i in indices:
+                    ticker, date_str, tweets = requests[i]
+                    self.logger.info(f"\n📌 Summary for {ticker} on {date_str}")
+                    self.logger.info(f"🗞️ Tweet count: {len(tweets)}")
+                    self.logger.info(f"🧾 Summary: {summary}")
+                    records.append((ticker, date_str, tweets, prompt, summary))
+                    summaries[i] = summary
+
+            # Save the new summaries of this batch together
+            self.save_summaries(records)
+
+        return summaries
     
     def is_informative(self, summary):
-        neg = r'.*[nN]o.*information.*|.*[nN]o.*facts.*|.*[nN]o.*mention.*|.*[nN]o.*tweets.*|.*do not contain.*'
-        return not re.match(neg, summary)
\ No newline at end of file
+        return is_informative(summary)
\ No newline at end of file
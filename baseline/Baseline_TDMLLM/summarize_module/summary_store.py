@@ -0,0 +1,302 @@
+import re
+import json
+import sqlite3
+import time
+import hashlib
+import argparse
+from pathlib import Path
+
+INFORMATIVE_NEG_PATTERN = r'.*[nN]o.*information.*|.*[nN]o.*facts.*|.*[nN]o.*mention.*|.*[nN]o.*tweets.*|.*do not contain.*'
+
+
+def is_informative(summary):
+    return not re.match(INFORMATIVE_NEG_PATTERN, summary)
+
+
+def stable_hash(value):
+    payload = json.dumps(value, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SummaryStore:
+    """Content-addressed summaries in one SQLite file, `summaries/summaries.sqlite`.
+
+    `summary_content` holds each generated summary once, keyed by a hash of
+    (generation config, rendered prompt), so identical prompts are never
+    summarized twice and any change to the model, its sampling settings,
+    the instruction, the examples or the tweets produces a new key.
+
+    `summary_index` maps (model, method, ticker, date) to a content key and
+    records the `fingerprint` (generation config + prompt template) it was
+    produced under. Lookups by date only trust rows with the current
+    fingerprint; rows imported from older layouts carry none and are
+    adopted by the Summarizer once their stored prompt matches the prompt
+    it renders now. Each row also records the `source` it was summarized
+    from (mtime and size of the tweet file, see `TweetFileStates`), so a
+    ticker-day whose tweets were edited or added since is not served from
+    the index: the Summarizer renders its prompt again, which reuses the
+    stored summary when the tweets turn out unchanged.
+
+    `summary_claims` records which worker of `precompute_summaries.py` is
+    working on a ticker-day, so concurrent workers do not summarize the
+    same day twice.
+
+    The database runs in WAL mode and the connection is opened lazily per
+    process, which keeps the store picklable for load workers.
+    """
+
+    DB_NAME = "summaries.sqlite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS summary_content (
+            key TEXT PRIMARY KEY,
+            summary TEXT,
+            informative INTEGER NOT NULL,
+            prompt TEXT
+        );
+        CREATE TABLE IF NOT EXISTS summary_index (
+            model TEXT NOT NULL,
+            method TEXT NOT NULL,
+            ticker TEXT NOT NULL,
+            date TEXT NOT NULL,
+            key TEXT NOT NULL,
+            fingerprint TEXT,
+            tweet_data TEXT,
+            source TEXT,
+            PRIMARY KEY (model, method, ticker, date)
+        );
+        CREATE TABLE IF NOT EXISTS summary_claims (
+            model TEXT NOT NULL,
+            method TEXT NOT NULL,
+            ticker TEXT NOT NULL,
+            date TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            claimed_at REAL NOT NULL,
+            PRIMARY KEY (model, method, ticker, date)
+        );
+    """
+
+    def __init__(self, summaries_dir, model_name, method_name, generation_config=None, prompt_template="", logger=None, tweet_states=None):
+        self.logger = logger
+        self.summaries_dir = Path(summaries_dir)
+        self.tweet_states = tweet_states
+        self.model_name = model_name
+        self.method_name = method_name
+        self.generation_config = generation_config or {}
+        self.fingerprint = stable_hash({"generation": self.generation_config, "template": prompt_template})
+        self.summaries_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.summaries_dir / self.DB_NAME
+        self._conn = None
+        self.conn.executescript(self.SCHEMA)
+        self._migrate_flat_table()
+        self._migrate_source_column()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            # The sample prefetch thread uses the connection opened by the main thread
+            self._conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        return self._conn
+
+    def _migrate_flat_table(self):
+        """Move rows of the earlier single-table layout into content + index."""
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='summaries'"
+        ).fetchone()
+        if not exists:
+            return
+        rows = self.conn.execute("SELECT model, method, ticker, date, tweet_data, prompt, summary FROM summaries").fetchall()
+        for model, method, ticker, date, tweet_data, prompt, summary in rows:
+            self._import_record(model, method, ticker, date, json.loads(tweet_data) if tweet_data else None, prompt, summary)
+        with self.conn:
+            self.conn.execute("DROP TABLE summaries")
+
+    def _migrate_source_column(self):
+        """Add `source` to indexes created before it existed; their rows count as stale."""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(summary_index)")]
+        if "source" not in columns:
+            with self.conn:
+                self.conn.execute("ALTER TABLE summary_index ADD COLUMN source TEXT")
+
+    def source_state(self, ticker, date):
+        """State of the tweet file of a ticker-day, "" if there is none (or no `tweet_states`)."""
+        if self.tweet_states is None:
+            return ""
+        return self.tweet_states.get(ticker, date)
+
+    def content_key(self, prompt):
+        return stable_hash({"generation": self.generation_config, "prompt": prompt or ""})
+
+    def get_content(self, key):
+        """(summary, informative) stored under `key`, or None."""
+        row = self.conn.execute("SELECT summary, informative FROM summary_content WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], bool(row[1])
+
+    def load(self, ticker, date):
+        """Load the current summary record of a ticker-day if it exists and its tweets are unchanged."""
+        row = self.conn.execute(
+            "SELECT c.summary, c.informative, i.key, i.source FROM summary_index i JOIN summary_content c ON i.key = c.key "
+            "WHERE i.model=? AND i.method=? AND i.ticker=? AND i.date=? AND i.fingerprint=?",
+            (self.model_name, self.method_name, ticker, date, self.fingerprint)
+        ).fetchone()
+        if row is None or row[3] != self.source_state(ticker, date):
+            return None
+        return {"ticker": ticker, "date": date, "summary": row[0], "informative": bool(row[1]), "key": row[2]}
+
+    def load_indexed(self, ticker, date):
+        """(summary, prompt) a ticker-day is indexed under, whatever its fingerprint, or None."""
+        return self.conn.execute(
+            "SELECT c.summary, c.prompt FROM summary_index i JOIN summary_content c ON i.key = c.key "
+            "WHERE i.model=? AND i.method=? AND i.ticker=? AND i.date=?",
+            (self.model_name, self.method_name, ticker, date)
+        ).fetchone()
+
+    def index_state(self):
+        """[rows, last rowid] of the current index of this model/method; every save changes it."""
+        return list(self.conn.execute(
+            "SELECT COUNT(*), MAX(rowid) FROM summary_index WHERE model=? AND method=? AND fingerprint=?",
+            (self.model_name, self.method_name, self.fingerprint)
+        ).fetchone())
+
+    def load_many(self, ticker, dates):
+        """{date: (summary, informative)} for the current summaries among `dates` whose tweets are unchanged."""
+        wanted = set(dates)
+        rows = self.conn.execute(
+            "SELECT i.date, c.summary, c.informative, i.source FROM summary_index i JOIN summary_content c ON i.key = c.key "
+            "WHERE i.model=? AND i.method=? AND i.ticker=? AND i.fingerprint=?",
+            (self.model_name, self.method_name, ticker, self.fingerprint)
+        )
+        return {
+            date: (summary, bool(informative))
+            for date, summary, informative, source in rows
+            if date in wanted and source == self.source_state(ticker, date)
+        }
+
+    def save(self, ticker, date, tweet_data, prompt, summary):
+        """Save one summary."""
+        self.save_many([(ticker, date, tweet_data, prompt, summary)])
+
+    def save_many(self, records):
+        """Save (ticker, date, tweet_data, prompt, summary) records in one transaction."""
+        content_rows = []
+        index_rows = []
+        for ticker, date, tweet_data, prompt, summary in records:
+            content_rows.append(self._content_row(prompt, summary))
+            index_rows.append((self.model_name, self.method_name, ticker, date, content_rows[-1][0], self.fingerprint,
+                               json.dumps(tweet_data), self.source_state(ticker, date)))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO summary_content VALUES (?, ?, ?, ?)", content_rows)
+            self.conn.executemany("INSERT OR REPLACE INTO summary_index VALUES (?, ?, ?, ?, ?, ?, ?, ?)", index_rows)
+
+    def save_contents(self, records):
+        """Save (prompt, summary) records that belong to no ticker-day, e.g. summaries of tweet chunks."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO summary_content VALUES (?, ?, ?, ?)",
+                [self._content_row(prompt, summary) for prompt, summary in records]
+            )
+
+    def _content_row(self, prompt, summary):
+        return self.content_key(prompt), summary, int(bool(summary) and is_informative(summary)), prompt
+
+    def claim(self, days, owner, stale_after):
+        """Claim (ticker, date) days for `owner` and return the ones it now holds.
+
+        A day can be claimed if nobody holds it or its claim is older than
+        `stale_after` seconds (the worker holding it is presumed dead). Both
+        happen in one write transaction, so two workers never hold a day.
+        """
+        now = time.time()
+        keys = [(self.model_name, self.method_name, ticker, date) for ticker, date in days]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO summary_claims VALUES (?, ?, ?, ?, ?, ?)",
+                [key + (owner, now) for key in keys]
+            )
+            self.conn.executemany(
+                "UPDATE summary_claims SET owner=?, claimed_at=? "
+                "WHERE model=? AND method=? AND ticker=? AND date=? AND owner!=? AND claimed_at<?",
+                [(owner, now) + key + (owner, now - stale_after) for key in keys]
+            )
+        held = set(self.conn.execute(
+            "SELECT ticker, date FROM summary_claims WHERE model=? AND method=? AND owner=?",
+            (self.model_name, self.method_name, owner)
+        ).fetchall())
+        return [day for day in days if tuple(day) in held]
+
+    def refresh(self, days, owner):
+        """Renew `owner`'s claims on (ticker, date) days so they do not go stale while it works."""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE summary_claims SET claimed_at=? WHERE model=? AND method=? AND ticker=? AND date=? AND owner=?",
+                [(now, self.model_name, self.method_name, ticker, date, owner) for ticker, date in days]
+            )
+
+    def release(self, days, owner):
+        """Drop `owner`'s claims on (ticker, date) days."""
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM summary_claims WHERE model=? AND method=? AND ticker=? AND date=? AND owner=?",
+                [(self.model_name, self.method_name, ticker, date, owner) for ticker, date in days]
+            )
+
+    def _import_record(self, model, method, ticker, date, tweet_data, prompt, summary):
+        """Store a summary of unknown provenance: indexed without a fingerprint or source."""
+        content_row = self._content_row(prompt, summary)
+        key = content_row[0]
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO summary_content VALUES (?, ?, ?, ?)", content_row)
+            self.conn.execute(
+                "INSERT OR IGNORE INTO summary_index VALUES (?, ?, ?, ?, ?, NULL, ?, NULL)",
+                (model, method, ticker, date, key, json.dumps(tweet_data))
+            )
+
+    def import_json_tree(self, method_dir):
+        """Import a legacy `summaries/<model>/<method>/<ticker>/<date>.json` tree into this store."""
+        method_dir = Path(method_dir)
+        for summary_path in sorted(method_dir.glob("*/*.json")):
+            try:
+                with open(summary_path, 'r') as f:
+                    data = json.load(f)
+            except json.JSONDecodeError as e:
+                if self.logger:
+                    self.logger.error(f"Skipping unreadable summary {summary_path}: {e}")
+                continue
+            self._import_record(self.model_name, self.method_name, summary_path.parent.name, summary_path.stem,
+                                data.get("tweet_data"), data.get("prompt"), data.get("summary"))
+
+
+def read_stored_summaries(store, ticker, date_strs):
+    """Stored summaries of `date_strs` as {date: summary}; non-informative days map to None.
+
+    Module-level so parallel load workers can run it.
+    """
+    return {
+        date: summary if informative else None
+        for date, (summary, informative) in store.load_many(ticker, date_strs).items()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import JSON summary trees into summaries.sqlite")
+    parser.add_argument("--summaries_dir", type=str, required=True, help="The summaries/ directory of a dataset")
+    args = parser.parse_args()
+
+    summaries_dir = Path(args.summaries_dir)
+    for method_dir in sorted(p for p in summaries_dir.glob("*/*") if p.is_dir()):
+        model_name, method_name = method_dir.parent.name, method_dir.name
+        store = SummaryStore(summaries_dir, model_name, method_name)
+        store.import_json_tree(method_dir)
+        count = store.conn.execute(
+            "SELECT COUNT(*) FROM summary_index WHERE model=? AND method=?", (model_name, method_name)
+        ).fetchone()[0]
+        print(f"{model_name}/{method_name}: {count} summaries")
@@ -1,7 +1,8 @@
 import re
 import os
+from itertools import islice
 from tqdm import tqdm
-from models.llm import LLaMALLM
+from models.llm import build_llm
 from dataloader.dataloader import DataLoader
 from utils.prompts import (
     COMPANY_DESCRIPTION_INSTRUCTION, 
@@ -11,6 +12,11 @@ from utils.prompts import (
 )
 from utils.fewshots import PREDICT_FEW_SHOT_EXAMPLES
 from utils.metrics import calculate_metrics, save_metrics
+from utils.prefetch import Prefetcher
+from utils.prompt_budget import PromptBudget, split_summary_days
+from utils.generation_stats import GENERATION_STATS
+
+EVAL_GROUP_BATCHES = 4  # 每組一起生成的樣本數 = batch_size * EVAL_GROUP_BATCHES，讓長度分桶有得挑
 
 class TDMLLM:
     def __init__(self, args, logger):
@@ -18,7 +24,8 @@ class TDMLLM:
         self.logger = logger
         
         self.dataloader = DataLoader(args, logger)
-        self.llm = LLaMALLM(args, logger)
+        self._llm = None
+        self._prompt_budget = None
         self.company_description_prompt = COMPANY_DESCRIPTION_INSTRUCTION
         self.relative_company_prompt = RELATIVE_COMPANY_INSTSRUCTION
         self.predict_instuction = {
@@ -27,62 +34,97 @@ class TDMLLM:
         }
         self.predict_few_shot_examples = PREDICT_FEW_SHOT_EXAMPLES
 
+    @property
+    def llm(self):
+        # 延後載入預測模型，資料準備階段不需要 GPU
+        if self._llm is None:
+            self._llm = build_llm(self.args, self.logger)
+        return self._llm
+
+    @property
+    def prompt_budget(self):
+        if self._prompt_budget is None:
+            self._prompt_budget = PromptBudget(self.llm.tokenizer, self.args.max_prompt_tokens)
+        return self._prompt_budget
+
     def eval(self):
         self.logger.info("🔍 Loading test data...")
-        data = self.dataloader.load(flag='test')
-        data.to_csv('data.csv')
-        self.logger.info(f"✅ Loaded {len(data)} samples.")
+        if self.args.prefetch_samples > 0:
+            # 背景執行緒邊摘要邊產生樣本，預測不必等整個測試集建好
+            samples = enumerate(Prefetcher(self.dataloader.load(flag='test', stream=True), self.args.prefetch_samples))
+            total = None
+            self.logger.info(f"✅ Streaming samples, prefetching up to {self.args.prefetch_samples}.")
+        else:
+            data = self.dataloader.load(flag='test')
+            samples = data.iterrows()
+            total = len(data)
+            self.logger.info(f"✅ Loaded {len(data)} samples.")
 
         preds = []
         labels = []
         correct = 0
         incorrect = 0
 
-        for index, row in tqdm(data.iterrows(), total=len(data), desc="📊 Processing Samples"):
-            try:
+        group_size = max(1, self.args.batch_size) * EVAL_GROUP_BATCHES
+        progress = tqdm(total=total, desc="📊 Processing Samples")
+        while True:
+            group = list(islice(samples, group_size))
+            if not group:
+                break
+            progress.update(len(group))
+
+            # Step 1: 生成公司描述（整組樣本一起批次生成）
+            company_prompts = []
+            for index, row in group:
+                company_prompt = self._build_relative_company_prompt(row['ticker'])
+                if company_prompt.strip() == "":
+                    self.logger.error(f"🔥 Empty prompt generated for ticker: {row['ticker']}")
+                    continue
+                company_prompts.append((index, row, company_prompt))
+            company_descriptions = self.llm.generate_batch([("", prompt) for _, _, prompt in company_prompts], "company_description")
+
+            # Step 2: 生成預測
+            predict_results = self.llm.generate_batch([
+                (self.predict_instuction['system_prompt'], self._build_predict_instruction(company_description, row['summary']))
+                for (_, row, _), company_description in zip(company_prompts, company_descriptions)
+            ], "prediction")
+
+            for (index, row, _), predict_result in zip(company_prompts, predict_results):
                 ticker = row['ticker']
                 summary = row['summary']
                 label = row['target']
-                
-                # Step 1: 生成公司描述
-                company_prompt = self._build_relative_company_prompt(ticker)
-                if company_prompt.strip() == "":
-                    self.logger.error(f"🔥 Empty prompt generated for ticker: {ticker}")
-                    continue
-                
-                company_description = self.llm("", company_prompt)
-                
-                # Step 2: 生成預測
-                predict_prompt = self._build_predict_instruction(company_description, summary)
-                predict_result = self.llm(self.predict_instuction['system_prompt'], predict_prompt)
-                
-                # Step 3: 提取股票走勢
-                self.logger.info(f"\n📌 [{index}] Ticker: {ticker}")
-                self.logger.info(f"📝 Summary: {summary}")
-                self.logger.info(f"🎯 Target: {label}")
-                self.logger.info(f"🧠 Prediction: {predict_result}")
-
-                stock_movement = self._extract_stock_return(predict_result)
-                preds.append(stock_movement)
-                labels.append(label)
-
-                self.logger.info(f"Stock movement: {stock_movement}, Ground Truth: {label}")
-
-                if stock_movement == label:
-                    correct += 1
-                else:
+                try:
+                    # Step 3: 提取股票走勢
+                    self.logger.info(f"\n📌 [{index}] Ticker: {ticker}")
+                    self.logger.info(f"📝 Summary: {summary}")
+                    self.logger.info(f"🎯 Target: {label}")
+                    self.logger.info(f"🧠 Prediction: {predict_result}")
+
+                    stock_movement = self._extract_stock_return(predict_result)
+                    preds.append(stock_movement)
+                    labels.append(label)
+
+                    self.logger.info(f"Stock movement: {stock_movement}, Ground Truth: {label}")
+
+                    if stock_movement == label:
+                        correct += 1
+                    else:
+                        incorrect += 1
+
+                except Exception as e:
+                    self.logger.exception(f"🔥 Error during prediction for ticker {ticker}")
+                    preds.append("Unknown")
+                    labels.append(label)
                     incorrect += 1
-                    
-            except Exception as e:
-                self.logger.exception(f"🔥 Error during prediction for ticker {ticker}")
-                preds.append("Unknown")
-                labels.append(label)
-                incorrect += 1
 
-            self.logger.info(f"Correct: {correct}, Incorrect: {incorrect}")
+                self.logger.info(f"Correct: {correct}, Incorrect: {incorrect}")
+        progress.close()
 
         metrics_result = calculate_metrics(preds, labels)
-        save_metrics(metrics_result, self.args.base_model, os.path.join("results", self.args.dataset_name), self.args.dataset_name)
+        metrics_path = save_metrics(metrics_result, self.args.base_model, os.path.join("results", self.args.dataset_name), self.args.dataset_name)
+        # 各階段（摘要、公司描述、預測）的 token 與時間統計，存在結果旁邊
+        stats_path = GENERATION_STATS.save(metrics_path.replace(".json", "_generation_stats.json"))
+        self.logger.info(f"📈 Generation stats: {stats_path}")
 
     def _extract_stock_return(self, text):
         text = text.lower().strip()
@@ -98,7 +140,17 @@ class TDMLLM:
         return self.company_description_prompt.format(ticker=ticker)
     
     def _build_predict_instruction(self, company_description, summary) -> str:
-        return self.predict_instuction['user_prompt'].format(
-                    company_description=company_description,
-                    summary=summary
-                )
\ No newline at end of file
+        def render(days):
+            return self.predict_instuction['user_prompt'].format(
+                        company_description=company_description,
+                        summary="".join(days)
+                    )
+
+        if self.args.max_prompt_tokens <= 0:
+            return render([summary])
+        # 超過 --max_prompt_tokens 時先捨棄最舊的摘要日
+        prompt, _ = self.prompt_budget.fit(
+            render, split_summary_days(summary), keep="tail",
+            reserve=self.prompt_budget.count(self.predict_instuction['system_prompt'])
+        )
+        return prompt
\ No newline at end of file
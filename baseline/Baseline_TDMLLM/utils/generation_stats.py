@@ -0,0 +1,67 @@
+import json
+import threading
+
+# Fields of a call record that add up over a stage
+SUMMED_FIELDS = [
+    "batch_size", "prompt_tokens", "padding_tokens", "cached_prefix_tokens",
+    "generated_tokens", "prefill_ms", "decode_ms", "latency_ms",
+    "target_forwards", "draft_tokens", "accepted_tokens"
+]
+
+
+def _rates(record):
+    padded = record.get("prompt_tokens", 0) + record.get("padding_tokens", 0)
+    record["padding_fraction"] = record.get("padding_tokens", 0) / padded if padded else 0.0
+    decode_ms = record.get("decode_ms", 0)
+    record["tokens_per_s"] = record.get("generated_tokens", 0) / (decode_ms / 1000) if decode_ms else 0.0
+    if record.get("draft_tokens"):
+        record["acceptance_rate"] = record["accepted_tokens"] / record["draft_tokens"]
+        record["tokens_per_forward"] = record["generated_tokens"] / record["target_forwards"] if record["target_forwards"] else 0.0
+    return record
+
+
+class GenerationStats:
+    """Token and latency accounting of every generate call, aggregated per pipeline stage.
+
+    A record holds the batch size, prompt / padding / cached-prefix /
+    generated token counts and the prefill and decode time of one
+    model.generate call (remote calls only have their latency). Under
+    speculative decoding it also holds the base model forwards and the
+    drafted and accepted tokens.
+    """
+
+    def __init__(self):
+        self.calls = []
+        # 預取執行緒的摘要與主執行緒的預測會同時記錄
+        self._lock = threading.Lock()
+
+    def record(self, stage, **fields):
+        record = _rates({"stage": stage, **fields})
+        with self._lock:
+            self.calls.append(record)
+        return record
+
+    def summary(self):
+        stages = {}
+        with self._lock:
+            calls = list(self.calls)
+        for call in calls:
+            stage = stages.setdefault(call["stage"], {"calls": 0, **{field: 0 for field in SUMMED_FIELDS}})
+            stage["calls"] += 1
+            for field in SUMMED_FIELDS:
+                stage[field] += call.get(field, 0)
+        for stage in stages.values():
+            _rates(stage)
+            # 加總後的 batch_size 是該階段的 prompt 總數
+            stage["prompts"] = stage.pop("batch_size")
+            stage["mean_batch_size"] = stage["prompts"] / stage["calls"]
+        return stages
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({"stages": self.summary(), "calls": self.calls}, f, indent=4)
+        return path
+
+
+# 同一行程中所有 LLaMALLM 共用，資料準備（摘要）與預測的時間記在同一份紀錄
+GENERATION_STATS = GenerationStats()
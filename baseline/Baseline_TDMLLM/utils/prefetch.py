@@ -0,0 +1,61 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+class Prefetcher:
+    """Iterate over `iterable` in a background thread, at most `max_items` ahead of the consumer.
+
+    Used to overlap building samples (which loads the summarizer and
+    generates the summaries of upcoming windows) with prediction: the
+    producer thread fills a bounded queue while the caller consumes it.
+    When the summarizer and the predictor share one registry model, their
+    generate calls take turns (see `generate_lock`); reading tweets,
+    filtering and building prompts still overlap with generation.
+    An exception raised by the producer is re-raised in the consumer, and
+    leaving the loop early stops the producer after its current item.
+    """
+
+    def __init__(self, iterable, max_items, name="sample-prefetch"):
+        self.iterable = iterable
+        self.queue = queue.Queue(maxsize=max(1, max_items))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, name=name, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # 以逾時重試，消費端提早結束時生產端才能停止
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            for item in self.iterable:
+                if not self._put((item, None)):
+                    return
+        except BaseException as e:
+            self._put((_DONE, e))
+            return
+        self._put((_DONE, None))
+
+    def __iter__(self):
+        try:
+            while True:
+                item, error = self.queue.get()
+                if item is _DONE:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
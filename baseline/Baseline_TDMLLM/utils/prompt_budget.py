@@ -0,0 +1,69 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+
+DAY_ENTRY_RE = re.compile(r"(?<=\n\n)(?=\d{4}-\d{2}-\d{2}\n)")
+
+
+def split_summary_days(summary):
+    """Split a window summary ("<date>\\n<summary>\\n\\n" per day) back into its day entries."""
+    return DAY_ENTRY_RE.split(summary) if summary else []
+
+
+class PromptBudget:
+    """Fits the variable part of a prompt (tweets, summary days) into `max_tokens`.
+
+    Token counts of static text (templates, few-shot examples, the prompt
+    rendered without items) and of each item are cached, so an item is
+    tokenized once no matter how many prompts it appears in. The number of
+    items to keep is estimated from their prefix sums and confirmed by a
+    binary search over full encodes, instead of re-encoding the prompt
+    after every dropped item.
+    """
+
+    def __init__(self, tokenizer, max_tokens, cache_size=1 << 16):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self._count = lru_cache(maxsize=cache_size)(self.length)
+
+    def count(self, item):
+        """Cached token count of an item.
+
+        Items that are not strings (e.g. tweets stored as token lists) are
+        counted as their str(), which is also how a prompt renders them.
+        """
+        return self._count(str(item))
+
+    def length(self, text):
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def fit(self, render, items, keep="head", reserve=0):
+        """Render the prompt with as many of `items` as fit, returning (prompt, kept items).
+
+        `render(items)` builds the prompt; `keep` says whether the first
+        ("head") or the last ("tail") items have priority, and `reserve`
+        tokens are left for text outside the prompt (e.g. a system prompt).
+        """
+        prompt = render(items)
+        budget = self.max_tokens - reserve
+        if self.max_tokens <= 0 or not items or self.length(prompt) <= budget:
+            return prompt, items
+
+        def take(k):
+            return items[:k] if keep == "head" else items[len(items) - k:]
+
+        ordered = items if keep == "head" else items[::-1]
+        costs = np.cumsum([self.count(item) for item in ordered])
+        estimate = int(np.searchsorted(costs, budget - self.count(render([])), side="right"))
+
+        # 以估計值為上限二分搜尋：找出實際編碼後仍在預算內的最多項數
+        low, high = 0, min(estimate, len(items) - 1)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.length(render(take(mid))) <= budget:
+                low = mid
+            else:
+                high = mid - 1
+        kept = take(low)
+        return render(kept), kept
@@ -11,6 +11,13 @@ not have relevant information to extract.
 News: {news}
 """
 
+NEWS_SUMMARY_REDUCE_INSTRUCTION="""The following are summaries of consecutive parts of one day's news data for {ticker} stock.
+Merge them into a single summary of the day and keep each fact only once. Give formatted answer such as Summary: ..., Keywords: ...
+You may put ’N/A’ if none of the parts has relevant information.
+Partial summaries:
+{summaries}
+"""
+
 RELATIVE_COMPANY_INSTSRUCTION="""List the top 3 NASDAQ stocks most similar to {ticker} stock."""
 
 PREDICT_INSTRUCTION_SYSTEM_PROMPT="""Instruction: Forecast next day stock return (price change) for symbol, given the company profile, historical weekly news summary,
@@ -1,37 +1,158 @@
 from summarize_module.summarizer import Summarizer
+from summarize_module.summary_store import read_stored_summaries
+from data_load.price_table import PriceCache, default_price_cache_dir, load_price_table
+from data_load.tweet_store import PackedTweetReader, default_packed_tweet_dir
+from data_load.tweet_filter import filter_tweets
+from data_load.relevance_filter import build_relevance_filter
 import os, json
 import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+def get_sentiment(date_str, price_table):
+    price_chg = price_table.get_movement(date_str)
+
+    if price_chg > 0.0:
+        sentiment = "Positive"
+    else:
+        sentiment = "Negative"
+    return sentiment
+
+
+class PartitionBuilder:
+    """Builds one ticker's partition of a split: price table, data range, day table and window samples.
+
+    Picklable (the summary store reconnects in each process), so load
+    workers can build whole partitions from the price files and the
+    stored summaries.
+    """
+
+    def __init__(self, flag, seq_len, price_cache, store):
+        self.flag = flag
+        self.seq_len = seq_len
+        self.price_cache = price_cache
+        self.store = store
+
+    def window_days(self, end_dates):
+        """Sorted calendar days covered by the seq_len-day windows ending at `end_dates`"""
+        offsets = np.arange(1, self.seq_len + 1)
+        return np.unique(end_dates[:, None] - offsets[None, :])
+
+    def partition(self, price_path):
+        """(ticker, price_table, data_range, end_dates, window days) of a price file"""
+        price_table = load_price_table(price_path, self.price_cache)
+        ticker = price_table.ticker
+
+        tes_idx = round(len(price_table) * 0.8)
+        end_idx = len(price_table)
+
+        if self.flag == "train":
+            # data_range = range(tes_idx)
+            data_range = range(14)
+        else:
+            data_range = range(tes_idx, end_idx)
+        end_dates = price_table.dates[np.asarray(data_range, dtype=int)]
+        return ticker, price_table, data_range, end_dates, self.window_days(end_dates)
+
+    def samples(self, partition, day_dates, day_entries, log_dates=False):
+        """The window samples of a partition given its informative days and the text each adds"""
+        ticker, price_table, data_range, end_dates, _ = partition
+        # Windows [end - seq_len, end) are sliced by searchsorted
+        window_starts = np.searchsorted(day_dates, end_dates - self.seq_len, side="left")
+        window_stops = np.searchsorted(day_dates, end_dates, side="left")
+
+        samples = []
+        for idx, start, stop in zip(data_range, window_starts, window_stops):
+            end_date_str = price_table.date_strs[idx]
+            if log_dates:
+                tqdm.write(f"End Date: {end_date_str}")
+            if stop > start:
+                target = get_sentiment(end_date_str, price_table)
+                samples.append({'ticker': ticker, 'summary': "".join(day_entries[start:stop]).rstrip(), 'target': target})
+        return samples
+
+    def build(self, price_path):
+        """Build a partition from the stored summaries alone, as (partition, stored summaries, samples).
+
+        The samples are None when a window day has no stored summary, for the
+        caller to summarize; a finished partition comes back as
+        (None, None, samples) so its price table is not sent back.
+        """
+        partition = self.partition(price_path)
+        ticker, *_, days = partition
+        date_strs = np.datetime_as_string(days, unit="D").tolist()
+        stored = read_stored_summaries(self.store, ticker, date_strs)
+        if len(stored) < len(date_strs):
+            return partition, stored, None
+
+        # Non-informative days are stored as None
+        informative = [(day, date_str) for day, date_str in zip(days, date_strs) if stored[date_str]]
+        day_dates = np.array([day for day, _ in informative], dtype="datetime64[D]")
+        day_entries = [date_str + "\n" + stored[date_str] + "\n\n" for _, date_str in informative]
+        return None, None, self.samples(partition, day_dates, day_entries)
+
+
+_worker_builder = None
+
+
+def _init_load_worker(builder):
+    # The builder (and its store connection) is unpickled once per worker, not once per ticker
+    global _worker_builder
+    _worker_builder = builder
+
+
+def _build_partition(price_path):
+    return _worker_builder.build(price_path)
+
+
 class DataLoader:
+    SAMPLE_COLUMNS = ['ticker', 'summary', 'target']
+
     def __init__(self, args):
         self.price_dir = args.price_dir
         self.tweet_dir = args.tweet_dir
         self.seq_len = args.seq_len
+        self.load_workers = args.load_workers
+        self.tweet_filter = args.tweet_filter
+        # Keep only the top-k tweets closest to the ticker in embedding space
+        self.relevance_filter = build_relevance_filter(args)
         self.summarizer = Summarizer(args)
+        self.price_cache = None
+        if not args.no_price_cache:
+            price_cache_dir = args.price_cache_dir or default_price_cache_dir(self.price_dir)
+            try:
+                self.price_cache = PriceCache(price_cache_dir)
+            except OSError as e:
+                print(f"Price cache disabled, cannot use {price_cache_dir}: {e}")
+        # Read from a corpus packed by `python -m data_load.tweet_store` when one exists
+        self.tweet_reader = None
+        self.stale_tickers = set()
+        packed_tweet_dir = args.packed_tweet_dir or default_packed_tweet_dir(self.tweet_dir)
+        if PackedTweetReader.is_packed(packed_tweet_dir):
+            self.tweet_reader = PackedTweetReader(packed_tweet_dir)
+            # Tickers added or changed after packing are read from the raw tree instead
+            self.stale_tickers = self.tweet_reader.stale_tickers(self.tweet_dir)
+            if self.stale_tickers:
+                print(f"Warning: {len(self.stale_tickers)} tickers changed since packing, reading them from {self.tweet_dir} "
+                      f"(repack with `python -m data_load.tweet_store`): {sorted(self.stale_tickers)}")
         # Initialize cache for summaries
         self.summary_cache = {}
 
 
-    def daterange(self, start_date, end_date):
-        for n in range(int((end_date - start_date).days)):
-            yield start_date + timedelta(n)
-
+    def get_tweets(self, ticker, date_str):
+        tweets = self.read_tweets(ticker, date_str)
+        if self.tweet_filter and tweets:
+            tweets = filter_tweets(tweets)
+        if self.relevance_filter is not None and tweets:
+            tweets = self.relevance_filter.filter(ticker, tweets)
+        return tweets
 
-    def get_sentiment(self, date_str, price_path):
-        price_data = np.genfromtxt(price_path, dtype=str, skip_header=False)
-        price_chg = price_data[price_data[:, 0] == date_str][0, 1].astype(float)
 
-        if price_chg > 0.0:
-            sentiment = "Positive"
-        else:
-            sentiment = "Negative"
-        return sentiment
+    def read_tweets(self, ticker, date_str):
+        if self.tweet_reader is not None and ticker not in self.stale_tickers:
+            return self.tweet_reader.get_tweets(ticker, date_str)
 
-
-    def get_tweets(self, ticker, date_str):
         tweets = []
         tweet_path = os.path.join(self.tweet_dir, ticker, date_str)
         if os.path.exists(tweet_path):
@@ -43,60 +164,83 @@ class DataLoader:
         return tweets
 
 
-    def get_cached_summary(self, ticker, date_str, tweet_data):
+    def cache_summary(self, ticker, date_str, summary):
+        """Cache a day's summary, or None when it is not informative"""
+        cache_key = f"{ticker}_{date_str}"
+        if summary and summary is not None and summary != "" and self.summarizer.is_informative(summary):
+            self.summary_cache[cache_key] = summary
+        else:
+            self.summary_cache[cache_key] = None
+        return self.summary_cache[cache_key]
+
+
+    def get_cached_summary(self, ticker, date_str):
         """Get summary from cache or generate new one if not cached"""
         cache_key = f"{ticker}_{date_str}"
         if cache_key not in self.summary_cache:
+            tweet_data = self.get_tweets(ticker, date_str)
             summary = self.summarizer.get_summary(ticker, date_str, tweet_data)
-            if summary and summary is not None and summary != "" and self.summarizer.is_informative(summary):
-                self.summary_cache[cache_key] = summary
-            else:
-                self.summary_cache[cache_key] = None
+            self.cache_summary(ticker, date_str, summary)
         return self.summary_cache[cache_key]
 
 
-    def load(self, flag):
-        data = pd.DataFrame()
-        stock_files = os.listdir(self.price_dir)
-        
-        with tqdm(total=len(stock_files), desc="Processing Stocks", position=0, leave=True) as outer_bar:
-            for file in os.listdir(self.price_dir):
-                price_path = os.path.join(self.price_dir, file)
-                ordered_price_data = np.flip(np.genfromtxt(price_path, dtype=str, skip_header=False), 0)
-                ticker = file[:-4]
-
-                tes_idx = round(len(ordered_price_data) * 0.8)
-                end_idx = len(ordered_price_data)
-
-                if flag == "train":
-                    # data_range = range(tes_idx)
-                    data_range = range(14)
-                else:
-                    data_range = range(tes_idx, end_idx)
-
-                with tqdm(total=len(data_range), desc=f"{ticker} Processing", position=1, leave=True) as inner_bar:
-                    for idx in data_range:
-                        summary_all = ""
-
-                        end_date_str = ordered_price_data[idx, 0]
-                        tqdm.write(f"End Date: {end_date_str}")
-                        end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
-                        start_date = end_date - timedelta(days=self.seq_len)
-                        target = self.get_sentiment(end_date_str, price_path)
-                        
-                        for seq_date in self.daterange(start_date, end_date):
-                            seq_date_str = seq_date.strftime("%Y-%m-%d")    
-
-                            tweet_data = self.get_tweets(ticker, seq_date_str)
-                            summary = self.get_cached_summary(ticker, seq_date_str, tweet_data)
-
-                            if summary:
-                                summary_all = summary_all + seq_date_str + "\n" + summary + "\n\n"
-
-                        if summary_all != "":
-                            data = pd.concat([data, pd.DataFrame([{'ticker': ticker, 'summary': summary_all.rstrip(), 'target': target}])], ignore_index=True)
-
-                        inner_bar.update(1)
-                outer_bar.update(1)
+    def build_day_table(self, ticker, days, stored_summaries=None):
+        """Informative days (sorted datetime64) and the text each adds to a window summary.
 
-            return data
+        Days in `stored_summaries` were already read by a load worker.
+        """
+        informative_days = []
+        entries = []
+        for day, date_str in zip(days, np.datetime_as_string(days, unit="D").tolist()):
+            if stored_summaries is not None and date_str in stored_summaries:
+                summary = self.cache_summary(ticker, date_str, stored_summaries[date_str])
+            else:
+                summary = self.get_cached_summary(ticker, date_str)
+            if summary:
+                informative_days.append(day)
+                entries.append(date_str + "\n" + summary + "\n\n")
+        return np.array(informative_days, dtype="datetime64[D]"), entries
+
+
+    def load(self, flag, stream=False):
+        """Return the samples of a split as a DataFrame, or as the
+        `iter_samples` generator when `stream` is set."""
+        samples = self.iter_samples(flag)
+        if stream:
+            return samples
+        return pd.DataFrame.from_records(list(samples), columns=self.SAMPLE_COLUMNS)
+
+
+    def partition_builder(self, flag):
+        return PartitionBuilder(flag, self.seq_len, self.price_cache, self.summarizer.store)
+
+
+    def iter_built_partitions(self, builder, price_paths):
+        """`builder.build` of every price file, in price file order.
+
+        With `load_workers` > 1 the partitions are built in a process pool;
+        otherwise in this process, so a partition whose days are all stored
+        never reads a tweet either way.
+        """
+        if self.load_workers <= 1:
+            yield from map(builder.build, price_paths)
+            return
+
+        chunksize = max(1, len(price_paths) // (self.load_workers * 4))
+        with ProcessPoolExecutor(max_workers=self.load_workers, initializer=_init_load_worker, initargs=(builder,)) as executor:
+            yield from executor.map(_build_partition, price_paths, chunksize=chunksize)
+
+
+    def iter_samples(self, flag):
+        builder = self.partition_builder(flag)
+        price_paths = [os.path.join(self.price_dir, file) for file in os.listdir(self.price_dir)]
+
+        with tqdm(total=len(price_paths), desc="Processing Stocks", position=0, leave=True) as outer_bar:
+            for partition, stored_summaries, samples in self.iter_built_partitions(builder, price_paths):
+                if samples is None:
+                    # Each day is summarized once, then the windows are sliced
+                    ticker, *_, days = partition
+                    day_dates, day_entries = self.build_day_table(ticker, days, stored_summaries)
+                    samples = builder.samples(partition, day_dates, day_entries, log_dates=True)
+                yield from samples
+                outer_bar.update(1)
@@ -0,0 +1,128 @@
+import os
+import json
+import numpy as np
+
+
+class PriceTable:
+    """Typed, in-memory view of one preprocessed price file.
+
+    The file is parsed once into a datetime64 date column and a float64 value
+    matrix. Rows are kept in the order the DataLoader has always used
+    (the file flipped, i.e. oldest first) and `index` maps a date string to
+    its row.
+    """
+
+    def __init__(self, ticker, dates, values):
+        self.ticker = ticker
+        self.dates = dates
+        self.values = values
+        self.date_strs = np.datetime_as_string(dates, unit="D")
+        self.index = {date_str: idx for idx, date_str in enumerate(self.date_strs.tolist())}
+
+    @classmethod
+    def from_file(cls, price_path):
+        raw = np.atleast_2d(np.genfromtxt(price_path, dtype=str, skip_header=False))
+        raw = np.flip(raw, 0)
+        ticker = os.path.basename(price_path)[:-4]
+        return cls(ticker, raw[:, 0].astype("datetime64[D]"), raw[:, 1:].astype(np.float64))
+
+    @classmethod
+    def from_records(cls, ticker, records):
+        return cls(ticker, records["date"], records["values"])
+
+    def to_records(self):
+        dtype = [("date", "datetime64[D]"), ("values", np.float64, (self.values.shape[1],))]
+        records = np.empty(len(self), dtype=dtype)
+        records["date"] = self.dates
+        records["values"] = self.values
+        return records
+
+    def __len__(self):
+        return len(self.dates)
+
+    @property
+    def movement(self):
+        """Daily price change, the column used for the target label."""
+        return self.values[:, 0]
+
+    def get_movement(self, date_str):
+        return self.movement[self.index[date_str]]
+
+    def indices_between(self, start_date, end_date):
+        """Row indices whose date falls within [start_date, end_date]."""
+        start = np.datetime64(start_date, "D")
+        end = np.datetime64(end_date, "D")
+        return np.flatnonzero((self.dates >= start) & (self.dates <= end)).tolist()
+
+
+class PriceCache:
+    """Persistent binary copies of the price files.
+
+    Each source file is compiled once into `<cache_dir>/<ticker>.npy` (a
+    structured array of date and values) and later opened with
+    `np.load(mmap_mode='r')`, so repeated runs and concurrent workers share
+    the same pages. A `<ticker>.json` sidecar records the source mtime and
+    size; a file whose stat no longer matches is recompiled. Each ticker has
+    its own sidecar, so concurrent workers never overwrite each other's
+    entries and compiling a ticker rewrites only its own metadata.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path, 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def load(self, price_path):
+        name = os.path.basename(price_path)
+        ticker = name[:-4]
+        npy_path = os.path.join(self.cache_dir, f"{ticker}.npy")
+        meta_path = os.path.join(self.cache_dir, f"{ticker}.json")
+        stat = os.stat(price_path)
+
+        entry = self._read_meta(meta_path)
+        if (entry is not None and entry["mtime_ns"] == stat.st_mtime_ns
+                and entry["size"] == stat.st_size and os.path.exists(npy_path)):
+            return PriceTable.from_records(ticker, np.load(npy_path, mmap_mode='r'))
+
+        table = PriceTable.from_file(price_path)
+        try:
+            tmp_path = f"{npy_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, table.to_records())
+            os.replace(tmp_path, npy_path)
+            # written after the array, so a sidecar that matches always describes the array on disk
+            self._write_meta(meta_path, {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "rows": len(table)})
+        except OSError as e:
+            print(f"Could not write price cache for {ticker}: {e}")
+        return table
+
+
+_price_tables = {}
+
+
+def default_price_cache_dir(price_dir):
+    """`<dataset>/price/preprocessed/` is cached under `<dataset>/price/compiled/`."""
+    return os.path.join(os.path.dirname(os.path.normpath(price_dir)), "compiled")
+
+
+def load_price_table(price_path, price_cache=None):
+    """Return the parsed table for `price_path`, parsing it at most once per process."""
+    table = _price_tables.get(price_path)
+    if table is None:
+        if price_cache is not None:
+            table = price_cache.load(price_path)
+        else:
+            table = PriceTable.from_file(price_path)
+        _price_tables[price_path] = table
+    return table
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import hashlib
+import numpy as np
+
+DEFAULT_RELEVANCE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def _get_sentence_transformers():
+    try:
+        import sentence_transformers
+    except ImportError as e:
+        raise ImportError("--relevance_top_k requires the `sentence-transformers` package") from e
+    return sentence_transformers
+
+
+class RelevanceFilter:
+    """Keeps the `top_k` texts of a ticker-day closest to the ticker in embedding space.
+
+    Texts are embedded on CPU by a small sentence encoder, in batches, and
+    the normalized vectors are cached on disk in
+    `<cache_dir>/embeddings.sqlite` keyed by (model, sha1 of the text), so
+    a text is embedded once across runs, tickers and split rebuilds. Kept
+    texts stay in their original order.
+    """
+
+    DB_NAME = "embeddings.sqlite"
+
+    def __init__(self, model_name, top_k, cache_dir, batch_size=64):
+        self.model_name = model_name
+        self.top_k = top_k
+        self.batch_size = batch_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, self.DB_NAME)
+        self._model = None
+        self._conn = None
+        self.queries = {}
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = _get_sentence_transformers().SentenceTransformer(self.model_name, device="cpu")
+        return self._model
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            # The sample prefetch thread uses this connection too
+            self._conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, key TEXT NOT NULL, "
+                "vector BLOB NOT NULL, PRIMARY KEY (model, key))"
+            )
+        return self._conn
+
+    def embed(self, texts):
+        """Normalized float32 embeddings of `texts`, read from the cache where possible."""
+        keys = [hashlib.sha1(text.encode("utf-8")).hexdigest() for text in texts]
+        cached = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE model=? AND key IN ({','.join('?' * len(chunk))})",
+                [self.model_name, *chunk]
+            )
+            cached.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+        if missing:
+            vectors = self.model.encode(
+                list(missing.values()), batch_size=self.batch_size,
+                normalize_embeddings=True, convert_to_numpy=True
+            ).astype(np.float32)
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                    [(self.model_name, key, vector.tobytes()) for key, vector in zip(missing, vectors)]
+                )
+            cached.update(zip(missing, vectors))
+        return np.stack([cached[key] for key in keys])
+
+    def query(self, ticker):
+        if ticker not in self.queries:
+            self.queries[ticker] = self.embed([f"${ticker} {ticker} stock news"])[0]
+        return self.queries[ticker]
+
+    def filter(self, ticker, texts):
+        if self.top_k <= 0 or len(texts) <= self.top_k:
+            return texts
+        strings = [" ".join(text) if isinstance(text, list) else text for text in texts]
+        scores = self.embed(strings) @ self.query(ticker)
+        keep = np.sort(np.argpartition(-scores, self.top_k - 1)[:self.top_k])
+        return [texts[i] for i in keep]
+
+
+def build_relevance_filter(args):
+    """The RelevanceFilter configured by `--relevance_top_k` and friends, or None when disabled."""
+    if args.relevance_top_k <= 0:
+        return None
+    cache_dir = args.embedding_cache_dir or os.path.join(os.path.dirname(os.path.normpath(args.tweet_dir)), "embeddings")
+    return RelevanceFilter(args.relevance_model, args.relevance_top_k, cache_dir)
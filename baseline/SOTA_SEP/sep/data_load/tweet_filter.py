@@ -0,0 +1,132 @@
+import re
+import hashlib
+import numpy as np
+
+# Bump when the filter's output changes, so summaries of filtered days are regenerated
+FILTER_VERSION = 1
+
+URL_RE = re.compile(r"https?://\S+|www\.\S+")
+RETWEET_RE = re.compile(r"^RT @\w+:\s*")
+CASHTAG_RE = re.compile(r"\$[A-Za-z][A-Za-z.]{0,5}\b")
+WORD_RE = re.compile(r"[\w$#@']+")
+SPACE_RE = re.compile(r"\s+")
+
+MAX_CASHTAGS = 5        # more cashtags than this is a multi-ticker blast
+MAX_CAPS_RATIO = 0.6    # mostly upper-case text is promotion
+MIN_CAPS_LETTERS = 20
+NEAR_DUP_BITS = 3       # SimHash Hamming distance up to which texts are near duplicates
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+_BITS = np.arange(64, dtype=np.uint64)
+_token_hashes = {}
+
+
+def normalize_tweet(text):
+    """Drop the retweet prefix and URLs, upper-case cashtags and collapse whitespace."""
+    if isinstance(text, list):
+        text = " ".join(text)
+    text = RETWEET_RE.sub("", text)
+    text = URL_RE.sub("", text)
+    text = CASHTAG_RE.sub(lambda m: m.group(0).upper(), text)
+    return SPACE_RE.sub(" ", text).strip()
+
+
+def _token_hash(token):
+    value = _token_hashes.get(token)
+    if value is None:
+        value = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+        _token_hashes[token] = value
+    return value
+
+
+def simhash(texts):
+    """64-bit SimHash of each text over its lower-cased words, as a uint64 array."""
+    token_lists = [WORD_RE.findall(text.lower()) or [""] for text in texts]
+    lengths = np.array([len(tokens) for tokens in token_lists])
+    hashes = np.array([_token_hash(token) for tokens in token_lists for token in tokens], dtype=np.uint64)
+    # Every token votes +1/-1 on each of the 64 bits; votes are summed per text
+    votes = ((hashes[:, None] >> _BITS[None, :]) & np.uint64(1)).astype(np.int32) * 2 - 1
+    sums = np.add.reduceat(votes, np.concatenate(([0], np.cumsum(lengths)[:-1])), axis=0)
+    return ((sums > 0).astype(np.uint64) << _BITS[None, :]).sum(axis=1, dtype=np.uint64)
+
+
+def hamming_distances(value, others):
+    return _POPCOUNT8[(others ^ value).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def band_values(hashes, num_bands):
+    """(len(hashes), num_bands) array of each hash's value in each of `num_bands` bit bands."""
+    if num_bands > 64:
+        # Bands narrower than a bit: one band, every hash is compared with all
+        return np.zeros((len(hashes), 1), dtype=np.uint64)
+    width = 64 // num_bands
+    shifts = np.arange(num_bands, dtype=np.uint64) * np.uint64(width)
+    masks = np.full(num_bands, (1 << width) - 1, dtype=np.uint64)
+    # The last band takes the remaining bits
+    masks[-1] = np.uint64((1 << (64 - (num_bands - 1) * width)) - 1)
+    return (hashes[:, None] >> shifts[None, :]) & masks[None, :]
+
+
+def near_duplicate_mask(hashes, max_bits=NEAR_DUP_BITS):
+    """True for every text within `max_bits` of an earlier kept text.
+
+    Split into `max_bits + 1` bands, two hashes at most `max_bits` apart
+    agree on at least one whole band, so each kept text is compared only
+    with the texts sharing one of its band values instead of all of them.
+    """
+    duplicate = np.zeros(len(hashes), dtype=bool)
+    rows = band_values(hashes, max_bits + 1).tolist()
+    buckets = {}
+    for i, row in enumerate(rows):
+        for band, value in enumerate(row):
+            buckets.setdefault((band, value), []).append(i)
+    for i, row in enumerate(rows):
+        if duplicate[i]:
+            continue
+        candidates = np.unique(np.concatenate([buckets[band, value] for band, value in enumerate(row)]))
+        later = candidates[candidates > i]
+        if len(later):
+            duplicate[later[hamming_distances(hashes[i], hashes[later]) <= max_bits]] = True
+    return duplicate
+
+
+def spam_mask(texts):
+    """Cashtag blasts and mostly upper-case promotions."""
+    if not texts:
+        return np.zeros(0, dtype=bool)
+    # All texts are scanned as one string; each distinct character is classified once
+    joined = "\n".join(texts)
+    lengths = np.array([len(text) for text in texts])
+    starts = np.concatenate(([0], np.cumsum(lengths + 1)[:-1]))
+    codes = np.frombuffer(joined.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32)
+    chars, inverse = np.unique(codes, return_inverse=True)
+    chars = [chr(code) for code in chars.tolist()]
+    owner = np.repeat(np.arange(len(texts)), lengths + 1)[:len(codes)]
+    letters = np.bincount(owner[np.array([c.isalpha() for c in chars])[inverse]], minlength=len(texts))
+    capitals = np.bincount(owner[np.array([c.isupper() for c in chars])[inverse]], minlength=len(texts))
+    # The newline separator cannot be part of a cashtag, so matches never span two texts
+    matches = np.array([match.start() for match in CASHTAG_RE.finditer(joined)], dtype=np.int64)
+    cashtags = np.bincount(np.searchsorted(starts, matches, side="right") - 1, minlength=len(texts))
+    caps_ratio = capitals / np.maximum(letters, 1)
+    return (cashtags > MAX_CASHTAGS) | ((letters >= MIN_CAPS_LETTERS) & (caps_ratio > MAX_CAPS_RATIO))
+
+
+def filter_tweets(tweets):
+    """Normalized tweets of a day without exact or near duplicates and spam, in their original order."""
+    texts = [normalize_tweet(tweet) for tweet in tweets]
+    texts = [text for text in texts if text]
+    if not texts:
+        return []
+
+    # Exact duplicates: same normalized, lower-cased text
+    keys = np.array([text.lower() for text in texts], dtype=object)
+    _, first = np.unique(keys, return_index=True)
+    keep = np.zeros(len(texts), dtype=bool)
+    keep[first] = True
+
+    keep &= ~spam_mask(texts)
+    candidates = np.flatnonzero(keep)
+    if len(candidates) > 1:
+        hashes = simhash([texts[i] for i in candidates])
+        keep[candidates[near_duplicate_mask(hashes)]] = False
+    return [text for text, kept in zip(texts, keep) if kept]
@@ -0,0 +1,200 @@
+import os
+import json
+import mmap
+import argparse
+from tqdm import tqdm
+
+MANIFEST = "manifest.json"
+
+
+def _get_zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd compression requires the `zstandard` package") from e
+    return zstandard
+
+
+def default_packed_tweet_dir(tweet_dir):
+    """`<dataset>/tweet/raw/` is packed into `<dataset>/tweet/packed/`."""
+    return os.path.join(os.path.dirname(os.path.normpath(tweet_dir)), "packed")
+
+
+def read_raw_tweets(tweet_path):
+    tweets = []
+    with open(tweet_path) as f:
+        for line in f:
+            if line.strip():
+                tweets.append(json.loads(line)['text'])
+    return tweets
+
+
+def day_states(ticker_dir):
+    """{date: [mtime_ns, size]} of the raw tweet files of a ticker directory, from one scan of it."""
+    states = {}
+    with os.scandir(ticker_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                states[entry.name] = [stat.st_mtime_ns, stat.st_size]
+    return states
+
+
+def read_shard_index(packed_dir, ticker):
+    """{date: [offset, length, count, mtime_ns, size]} of a ticker's shard, or None if it has none."""
+    idx_path = os.path.join(packed_dir, f"{ticker}.idx.json")
+    if not os.path.exists(idx_path):
+        return None
+    with open(idx_path, 'r') as f:
+        return json.load(f)
+
+
+def pack_corpus(tweet_dir, packed_dir, compression="none"):
+    """Pack a raw `<TICKER>/<YYYY-MM-DD>` tree into one shard per ticker.
+
+    `<TICKER>.bin` holds one block per day (a JSON list of tweet texts,
+    zstd-compressed when `compression == "zstd"`) and `<TICKER>.idx.json`
+    maps each date to the block's [offset, length, count] and the
+    [mtime_ns, size] of the raw file it was packed from, so readers can tell
+    which tickers changed after packing, even by a tweet appended to a day.
+    """
+    os.makedirs(packed_dir, exist_ok=True)
+    compressor = _get_zstd().ZstdCompressor(level=3) if compression == "zstd" else None
+
+    tickers = sorted(d for d in os.listdir(tweet_dir) if os.path.isdir(os.path.join(tweet_dir, d)))
+    num_days = 0
+    for ticker in tqdm(tickers, desc="Packing tweets"):
+        ticker_dir = os.path.join(tweet_dir, ticker)
+        # States are taken before reading, so a file written meanwhile shows up as stale
+        states = day_states(ticker_dir)
+        index = {}
+        shard_path = os.path.join(packed_dir, f"{ticker}.bin")
+        with open(shard_path + ".tmp", 'wb') as shard:
+            for date_str in sorted(states):
+                tweets = read_raw_tweets(os.path.join(ticker_dir, date_str))
+                block = json.dumps(tweets).encode("utf-8")
+                if compressor is not None:
+                    block = compressor.compress(block)
+                index[date_str] = [shard.tell(), len(block), len(tweets)] + states[date_str]
+                shard.write(block)
+        os.replace(shard_path + ".tmp", shard_path)
+        with open(os.path.join(packed_dir, f"{ticker}.idx.json"), 'w') as f:
+            json.dump(index, f)
+        num_days += len(index)
+
+    with open(os.path.join(packed_dir, MANIFEST), 'w') as f:
+        json.dump({
+            "source": os.path.abspath(tweet_dir),
+            "compression": compression,
+            "tickers": len(tickers),
+            "days": num_days
+        }, f, indent=4)
+    return num_days
+
+
+class TweetFileStates:
+    """`<mtime_ns>:<size>` of the tweet file of each ticker-day, looked up once per ticker.
+
+    The summary store records this state with every summary to tell which
+    ones were generated from tweets that changed since. A ticker's states
+    come from one scan of its raw directory; once the raw tree is gone, from
+    its packed shard, which recorded them when packing.
+    """
+
+    def __init__(self, tweet_dir, packed_dir=""):
+        self.tweet_dir = tweet_dir
+        self.packed_dir = packed_dir
+        self.states = {}
+
+    def ticker_states(self, ticker):
+        if ticker not in self.states:
+            ticker_dir = os.path.join(self.tweet_dir, ticker)
+            if os.path.isdir(ticker_dir):
+                states = day_states(ticker_dir)
+            else:
+                index = read_shard_index(self.packed_dir, ticker) if self.packed_dir else None
+                states = {date_str: entry[3:] for date_str, entry in (index or {}).items()}
+            self.states[ticker] = {date_str: ":".join(map(str, state)) for date_str, state in states.items()}
+        return self.states[ticker]
+
+    def get(self, ticker, date_str):
+        return self.ticker_states(ticker).get(date_str, "")
+
+
+class PackedTweetReader:
+    """Reads tweets for a (ticker, date) from a corpus built by `pack_corpus`."""
+
+    def __init__(self, packed_dir):
+        self.packed_dir = packed_dir
+        with open(os.path.join(packed_dir, MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+        self.decompressor = None
+        if self.manifest["compression"] == "zstd":
+            self.decompressor = _get_zstd().ZstdDecompressor()
+        self.shards = {}
+
+    @classmethod
+    def is_packed(cls, packed_dir):
+        return os.path.exists(os.path.join(packed_dir, MANIFEST))
+
+    def stale_tickers(self, tweet_dir):
+        """Tickers of the raw tree at `tweet_dir` added or changed since packing, whose tweets must be read raw.
+
+        A ticker is stale if any day file was added, removed or changed in
+        mtime or size; shards packed without file states are always stale.
+        Without a raw tree the packed corpus is the only copy and nothing is stale.
+        """
+        if not os.path.isdir(tweet_dir):
+            return set()
+        stale = set()
+        for ticker in os.listdir(tweet_dir):
+            ticker_dir = os.path.join(tweet_dir, ticker)
+            if os.path.isdir(ticker_dir) and day_states(ticker_dir) != self.day_states(ticker):
+                stale.add(ticker)
+        return stale
+
+    def day_states(self, ticker):
+        """{date: [mtime_ns, size]} of the raw files a ticker's shard was packed from."""
+        index, _ = self._open_shard(ticker)
+        return {date_str: entry[3:] for date_str, entry in index.items()}
+
+    def _open_shard(self, ticker):
+        if ticker not in self.shards:
+            index = read_shard_index(self.packed_dir, ticker)
+            if index is None:
+                self.shards[ticker] = ({}, None)
+            else:
+                data = None
+                shard_path = os.path.join(self.packed_dir, f"{ticker}.bin")
+                if os.path.getsize(shard_path) > 0:
+                    with open(shard_path, 'rb') as f:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.shards[ticker] = (index, data)
+        return self.shards[ticker]
+
+    def has_day(self, ticker, date_str):
+        index, _ = self._open_shard(ticker)
+        return date_str in index
+
+    def get_tweets(self, ticker, date_str):
+        index, data = self._open_shard(ticker)
+        entry = index.get(date_str)
+        if entry is None:
+            return []
+        offset, length = entry[:2]
+        block = data[offset:offset + length]
+        if self.decompressor is not None:
+            block = self.decompressor.decompress(block)
+        return json.loads(block)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a raw tweet/news tree into per-ticker shards")
+    parser.add_argument("--tweet_dir", type=str, required=True, help="Raw corpus, e.g. .../tweet/raw/")
+    parser.add_argument("--packed_dir", type=str, default="", help="Output directory (default: .../tweet/packed/)")
+    parser.add_argument("--compression", type=str, default="none", choices=["none", "zstd"])
+    args = parser.parse_args()
+
+    packed_dir = args.packed_dir or default_packed_tweet_dir(args.tweet_dir)
+    num_days = pack_corpus(args.tweet_dir, packed_dir, args.compression)
+    print(f"Packed {num_days} ticker-days into {packed_dir}")
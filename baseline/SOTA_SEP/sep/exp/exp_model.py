@@ -1,41 +1,89 @@
 from data_load.dataloader import DataLoader
 from explain_module.util import summarize_trial, remove_reflections, save_results#, save_agents
-from explain_module.agents import PredictReflectAgent
-from predict_module.merge_peft_adapter import merge_peft_adapter
-from predict_module.supervised_finetune import supervised_finetune
-from predict_module.train_reward_model import train_reward_model
-from predict_module.tuning_lm_with_rl import tuning_lm_with_rl
-from transformers import LlamaTokenizer, pipeline, BitsAndBytesConfig #, AutoModelForCausalLM
-from trl import AutoModelForCausalLMWithValueHead
+from explain_module.agents import PredictReflectAgent, run_agents
+from utils.prefetch import Prefetcher
+from utils.prompt_budget import PromptBudget
+from utils.llm import build_llm #, OpenAILLM
 import os, json
-import torch
+from itertools import islice
+# torch, transformers, trl and peft (via predict_module) are imported inside
+# train() and test(), so importing this module does not load them
+
+# Agents run together per group of llm_batch_size * AGENT_GROUP_BATCHES, so length bucketing has prompts to choose from
+AGENT_GROUP_BATCHES = 4
 
 
 class Exp_Model:
     def __init__(self, args):
         self.args = args
         self.dataloader = DataLoader(args)
-
+        # Agent prompts drop their oldest summary days beyond --max_prompt_tokens
+        self.prompt_budget = None
+        if args.max_prompt_tokens > 0:
+            from transformers import AutoTokenizer
+            self.prompt_budget = PromptBudget(AutoTokenizer.from_pretrained(args.base_model), args.max_prompt_tokens)
+        self.agent_llms = None
+
+    def build_agent_llms(self):
+        """Predict and reflect LLMs of the train agents, built on first use (both share one set of weights)."""
+        if self.agent_llms is None:
+            llm_kwargs = {
+                "base_model": self.args.base_model,
+                "dtype": self.args.dtype,
+                "batch_size": self.args.llm_batch_size,
+                "max_batch_tokens": self.args.max_batch_tokens,
+                "prefix_cache": self.args.prefix_cache
+            }
+            self.agent_llms = {
+                "predict_llm": build_llm(self.args.llm_server, **llm_kwargs),
+                "reflect_llm": build_llm(self.args.llm_server, **llm_kwargs)
+            }
+            # self.agent_llms = {"predict_llm": OpenAILLM(), "reflect_llm": OpenAILLM()}
+        return self.agent_llms
+
+    def agent_groups(self, items):
+        items = iter(items)
+        group_size = max(1, self.args.llm_batch_size) * AGENT_GROUP_BATCHES
+        while True:
+            group = list(islice(items, group_size))
+            if not group:
+                return
+            yield group
 
     def train(self):
+        from predict_module.merge_peft_adapter import merge_peft_adapter
+        from predict_module.supervised_finetune import supervised_finetune
+        from predict_module.train_reward_model import train_reward_model
+        from predict_module.tuning_lm_with_rl import tuning_lm_with_rl
+
         # Collect demonstration data
         print("Loading Train Agents...")
-        data = self.dataloader.load(flag="train")
+        if self.args.prefetch_samples > 0:
+            # Samples (and their summaries) are built in a background thread while the agents run
+            rows = Prefetcher(self.dataloader.load(flag="train", stream=True), self.args.prefetch_samples)
+        else:
+            data = self.dataloader.load(flag="train")
+            rows = [row for _, row in data.iterrows()]
+            print("Loaded Train Agents.")
 
         agent_cls = PredictReflectAgent
-        agents = [agent_cls(row['ticker'], row['summary'], row['target']) for _, row in data.iterrows()]
-        print("Loaded Train Agents.")
-
-        for agent in agents:
-            agent.run()
-
-            if agent.is_correct():
-                prompt = agent._build_agent_prompt()
-                response = agent.scratchpad.split('Price Movement: ')[-1]
+        agents = []
+        for group in self.agent_groups(rows):
+            group_agents = [
+                agent_cls(row['ticker'], row['summary'], row['target'], prompt_budget=self.prompt_budget, **self.build_agent_llms())
+                for row in group
+            ]
+            agents.extend(group_agents)
+            run_agents(group_agents)
+
+            for agent in group_agents:
+                if agent.is_correct():
+                    prompt = agent._build_agent_prompt()
+                    response = agent.scratchpad.split('Price Movement: ')[-1]
 
-                sample = {"instruction": prompt, "input": "", "output": response}
-                with open(self.args.data_path, 'a') as f:
-                    f.write(json.dumps(sample) + "\n")
+                    sample = {"instruction": prompt, "input": "", "output": response}
+                    with open(self.args.data_path, 'a') as f:
+                        f.write(json.dumps(sample) + "\n")
 
         correct, incorrect = summarize_trial(agents)
         print(f'Finished Trial 0, Correct: {len(correct)}, Incorrect: {len(incorrect)}')
@@ -48,17 +96,18 @@ class Exp_Model:
         comparison_data = []
 
         for trial in range(self.args.num_reflect_trials):
-            for idx, agent in enumerate([a for a in agents if not a.is_correct()]):
-                prev_response = agent.scratchpad.split('Price Movement: ')[-1]
-                agent.run()
+            for group in self.agent_groups([a for a in agents if not a.is_correct()]):
+                prev_responses = [agent.scratchpad.split('Price Movement: ')[-1] for agent in group]
+                run_agents(group)
 
-                if agent.is_correct():
-                    print(agent._build_agent_prompt(), "\n\n\n")
-                    prompt = remove_reflections(agent._build_agent_prompt())
-                    response = agent.scratchpad.split('Price Movement: ')[-1]
+                for agent, prev_response in zip(group, prev_responses):
+                    if agent.is_correct():
+                        print(agent._build_agent_prompt(), "\n\n\n")
+                        prompt = remove_reflections(agent._build_agent_prompt())
+                        response = agent.scratchpad.split('Price Movement: ')[-1]
 
-                    sample = {"user_input": prompt, "completion_a": prev_response, "completion_b": response}
-                    comparison_data.append(sample)
+                        sample = {"user_input": prompt, "completion_a": prev_response, "completion_b": response}
+                        comparison_data.append(sample)
 
             correct, incorrect = summarize_trial(agents)
             print(f'Finished Trial {trial+1}, Correct: {len(correct)}, Incorrect: {len(incorrect)}')
@@ -80,11 +129,15 @@ class Exp_Model:
 
 
     def test(self):
+        import torch
+        from transformers import LlamaTokenizer, pipeline, BitsAndBytesConfig #, AutoModelForCausalLM
+        from trl import AutoModelForCausalLMWithValueHead
+
         print("Loading Test Agents...")
         data = self.dataloader.load(flag="test")
 
         agent_cls = PredictReflectAgent
-        test_agents = [agent_cls(row['ticker'], row['summary'], row['target']) for _, row in data.iterrows()]
+        test_agents = [agent_cls(row['ticker'], row['summary'], row['target'], prompt_budget=self.prompt_budget) for _, row in data.iterrows()]
         print("Loaded Test Agents.")
 
         # Updated model initialization using BitsAndBytesConfig
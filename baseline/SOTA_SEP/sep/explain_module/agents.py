@@ -1,7 +1,8 @@
 from typing import List, Union, Literal
-from utils.llm import OpenAILLM, NShotLLM, LLaMALLM #, FastChatLLM
+from utils.llm import NShotLLM #, OpenAILLM, LLaMALLM, FastChatLLM
 from utils.prompts import REFLECT_INSTRUCTION, PREDICT_INSTRUCTION, PREDICT_REFLECT_INSTRUCTION, REFLECTION_HEADER
 from utils.fewshots import PREDICT_EXAMPLES
+from utils.prompt_budget import split_summary_days
 
 
 class PredictAgent:
@@ -9,8 +10,8 @@ class PredictAgent:
                  ticker: str,
                  summary: str,
                  target: str,
-                 predict_llm = LLaMALLM()
-                #  predict_llm = OpenAILLM()
+                 predict_llm = None,
+                 prompt_budget = None
                  ) -> None:
 
         self.ticker = ticker
@@ -20,11 +21,18 @@ class PredictAgent:
 
         self.predict_prompt = PREDICT_INSTRUCTION
         self.predict_examples = PREDICT_EXAMPLES
+        # LLMs are built by the caller (Exp_Model.build_agent_llms); run_n_shots brings its own
         self.llm = predict_llm
+        # Optional PromptBudget: the oldest summary days are dropped to fit it
+        self.prompt_budget = prompt_budget
 
         self.__reset_agent()
 
     def run(self, reset=True) -> None:
+        self._start_run(reset)
+        self._finish_run(self.prompt_agent())
+
+    def _start_run(self, reset=True) -> None:
         if reset:
             self.__reset_agent()
 
@@ -32,7 +40,8 @@ class PredictAgent:
         self.scratchpad += facts
         # print(facts, end="")
 
-        self.scratchpad += self.prompt_agent()
+    def _finish_run(self, response) -> None:
+        self.scratchpad += response
         response = self.scratchpad.split('Price Movement: ')[-1]
         self.prediction = response.split()[0]
         # print(response, end="\n\n\n\n")
@@ -43,10 +52,16 @@ class PredictAgent:
         return self.llm(self._build_agent_prompt())
 
     def _build_agent_prompt(self) -> str:
-        return self.predict_prompt.format(
+        return self._fit_summary(lambda days: self.predict_prompt.format(
                             ticker = self.ticker,
                             examples = self.predict_examples,
-                            summary = self.summary)
+                            summary = "".join(days)))
+
+    def _fit_summary(self, render) -> str:
+        if self.prompt_budget is None:
+            return render([self.summary])
+        prompt, _ = self.prompt_budget.fit(render, split_summary_days(self.summary), keep="tail")
+        return prompt
 
     def is_finished(self) -> bool:
         return self.finished
@@ -64,13 +79,12 @@ class PredictReflectAgent(PredictAgent):
                  ticker: str,
                  summary: str,
                  target: str,
-                 predict_llm = LLaMALLM(),
-                 reflect_llm = LLaMALLM()
-                #  predict_llm = OpenAILLM(),
-                #  reflect_llm = OpenAILLM()
+                 predict_llm = None,
+                 reflect_llm = None,
+                 prompt_budget = None
                  ) -> None:
 
-        super().__init__(ticker, summary, target, predict_llm)
+        super().__init__(ticker, summary, target, predict_llm, prompt_budget)
         self.predict_llm = predict_llm
         self.reflect_llm = reflect_llm
         self.reflect_prompt = REFLECT_INSTRUCTION
@@ -87,7 +101,9 @@ class PredictReflectAgent(PredictAgent):
 
     def reflect(self) -> None:
         print('Reflecting...\n')
-        reflection = self.prompt_reflection()
+        self._add_reflection(self.prompt_reflection())
+
+    def _add_reflection(self, reflection) -> None:
         self.reflections += [reflection]
         self.reflections_str = format_reflections(self.reflections)
         # print(self.reflections_str, end="\n\n\n\n")
@@ -101,11 +117,11 @@ class PredictReflectAgent(PredictAgent):
                             scratchpad = self.scratchpad)
 
     def _build_agent_prompt(self) -> str:
-        prompt = self.agent_prompt.format(
+        prompt = self._fit_summary(lambda days: self.agent_prompt.format(
                             ticker = self.ticker,
                             examples = self.predict_examples,
                             reflections = self.reflections_str,
-                            summary = self.summary)
+                            summary = "".join(days)))
         return prompt
 
     def run_n_shots(self, model, tokenizer, reward_model, num_shots=4, reset=True) -> None:
@@ -113,6 +129,27 @@ class PredictReflectAgent(PredictAgent):
         PredictAgent.run(self, reset=reset)
 
 
+def run_agents(agents: List[PredictReflectAgent]) -> None:
+    """Same as calling run() on each agent, with the reflect and predict calls of all agents batched.
+
+    The agents must share their LLMs (see Exp_Model.build_agent_llms).
+    """
+    if not agents:
+        return
+    to_reflect = [agent for agent in agents if agent.is_finished() and not agent.is_correct()]
+    if to_reflect:
+        print(f'Reflecting on {len(to_reflect)} agents...\n')
+        reflections = agents[0].reflect_llm.generate_batch([agent._build_reflection_prompt() for agent in to_reflect])
+        for agent, reflection in zip(to_reflect, reflections):
+            agent._add_reflection(reflection)
+
+    for agent in agents:
+        agent._start_run()
+    responses = agents[0].llm.generate_batch([agent._build_agent_prompt() for agent in agents])
+    for agent, response in zip(agents, responses):
+        agent._finish_run(response)
+
+
 def format_reflections(reflections: List[str], header: str = REFLECTION_HEADER) -> str:
     if reflections == []:
         return ''
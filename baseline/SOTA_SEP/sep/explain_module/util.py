@@ -44,11 +44,9 @@ def save_agents(agents, dir: str):
 
 def save_results(agents, dir: str):
     os.makedirs(dir, exist_ok=True)
-    results = pd.DataFrame()
-    for agent in agents:
-        results = pd.concat([results, pd.DataFrame([{
-                                        'Prompt': remove_fewshot(agent._build_agent_prompt()),
-                                        'Response': agent.scratchpad.split('Price Movement: ')[-1],
-                                        'Target': agent.target
-                                        }])], ignore_index=True)
+    results = pd.DataFrame({
+        'Prompt': [remove_fewshot(agent._build_agent_prompt()) for agent in agents],
+        'Response': [agent.scratchpad.split('Price Movement: ')[-1] for agent in agents],
+        'Target': [agent.target for agent in agents]
+    })
     results.to_csv(dir + 'results.csv', index=False)
@@ -1,20 +1,35 @@
 from exp.exp_model import Exp_Model
+from data_load.relevance_filter import DEFAULT_RELEVANCE_MODEL
+from utils.llm import BASE_MODEL
 import argparse
-import torch
 import numpy as np
 import random
 
-fix_seed = 100
-random.seed(fix_seed)
-torch.manual_seed(fix_seed)
-np.random.seed(fix_seed)
-
 parser = argparse.ArgumentParser(description='generating')
 
 # load data
 parser.add_argument("--price_dir", type=str, default="data/sample_price/preprocessed/")
 parser.add_argument("--tweet_dir", type=str, default="data/sample_tweet/raw/")
 parser.add_argument("--seq_len", type=int, default=5)
+parser.add_argument("--price_cache_dir", type=str, default="", help="directory for compiled price files (default: <price>/compiled/)")
+parser.add_argument("--no_price_cache", action="store_true", help="parse the text price files on every run")
+parser.add_argument("--summaries_only_from_cache", action="store_true", help="never load the summarizer model; days without a stored summary are skipped")
+parser.add_argument("--strict_summary_cache", action="store_true", help="like --summaries_only_from_cache, but fail on the first missing summary")
+parser.add_argument("--tweet_filter", action="store_true", help="drop duplicate, near-duplicate and spam tweets before summarizing")
+parser.add_argument("--relevance_top_k", type=int, default=0, help="keep only the k tweets of a day most similar to the ticker (sentence-transformers on CPU; 0 = off)")
+parser.add_argument("--relevance_model", type=str, default=DEFAULT_RELEVANCE_MODEL)
+parser.add_argument("--embedding_cache_dir", type=str, default="", help="on-disk embedding cache of the relevance filter (default: <tweet>/embeddings/)")
+parser.add_argument("--max_prompt_tokens", type=int, default=0, help="drop tweets / oldest summary days so summarize and predict prompts stay within this many tokens (0 = no limit)")
+parser.add_argument("--summary_chunk_tokens", type=int, default=0, help="summarize days whose tweets exceed this many tokens in chunks and merge the chunk summaries (0 = never)")
+parser.add_argument("--base_model", type=str, default=BASE_MODEL, help="model of the summarizer and the predict/reflect agents (must match the --llm_server's)")
+parser.add_argument("--dtype", type=str, default="float16", choices=["float16", "bfloat16", "float32"], help="weight dtype of --base_model (float32 for CPU-only runs)")
+parser.add_argument("--llm_server", type=str, default="", help="URL of a `python -m utils.llm_server` daemon to generate with instead of loading the model (e.g. http://127.0.0.1:8765)")
+parser.add_argument("--llm_batch_size", type=int, default=8, help="prompts per generation batch of the summarizer and the train agents")
+parser.add_argument("--prefix_cache", action="store_true", help="prefill the token prefix shared by a batch's prompts once and reuse its KV cache")
+parser.add_argument("--max_batch_tokens", type=int, default=0, help="cap a generation batch at this many tokens, rows x (longest prompt + max_new_tokens) (0 = only --llm_batch_size)")
+parser.add_argument("--prefetch_samples", type=int, default=0, help="build train samples in a background thread, up to this many ahead of the agents (0 = build the whole split first)")
+parser.add_argument("--load_workers", type=int, default=1, help="processes that build ticker partitions of the dataset from stored summaries")
+parser.add_argument("--packed_tweet_dir", type=str, default="", help="corpus built by `python -m data_load.tweet_store` (default: <tweet>/packed/, used if present)")
 
 # supervised finetuning
 parser.add_argument("--wandb", action="store_true", default=False)
@@ -75,6 +90,14 @@ args = parser.parse_args()
 print('Args in experiment:')
 print(args)
 
+# torch is imported after argument parsing, so `--help` and bad arguments return without loading it
+import torch
+
+fix_seed = 100
+random.seed(fix_seed)
+torch.manual_seed(fix_seed)
+np.random.seed(fix_seed)
+
 exp_model = Exp_Model(args)
 exp_model.train()
 exp_model.test()
@@ -1,10 +1,10 @@
-from utils.llm import OpenAILLM, LLaMALLM
-from utils.prompts import SUMMARIZE_INSTRUCTION, MY_SUMMARIZE_INSTRUCTION
+from utils.llm import OpenAILLM, GENERATION_KWARGS, build_llm
+from utils.prompts import SUMMARIZE_INSTRUCTION, MY_SUMMARIZE_INSTRUCTION, MY_SUMMARIZE_REDUCE_INSTRUCTION
 from utils.fewshots import SUMMARIZE_EXAMPLES
-import tiktoken
-import re
-import json
-import os
+from utils.prompt_budget import PromptBudget
+from summarize_module.summary_store import SummaryStore, is_informative
+from data_load.tweet_filter import FILTER_VERSION
+from data_load.tweet_store import TweetFileStates, default_packed_tweet_dir
 from pathlib import Path
 
 class Summarizer:
@@ -12,8 +12,23 @@ class Summarizer:
         self.summarize_prompt = MY_SUMMARIZE_INSTRUCTION
         # self.summarize_prompt = SUMMARIZE_INSTRUCTION
         self.summarize_examples = SUMMARIZE_EXAMPLES
+        self.reduce_prompt = MY_SUMMARIZE_REDUCE_INSTRUCTION
+        # Days whose tweets exceed this many tokens are summarized in chunks, then merged (0 = never)
+        self.chunk_tokens = args.summary_chunk_tokens
+        self._tokenizer = None
+        self.max_prompt_tokens = args.max_prompt_tokens
+        self._prompt_budget = None
         # self.llm = OpenAILLM()
-        self.llm = LLaMALLM()
+        self._llm = None
+        self.llm_server = args.llm_server
+        self.base_model = args.base_model
+        self.llm_kwargs = {
+            "base_model": args.base_model, "dtype": args.dtype,
+            "batch_size": args.llm_batch_size, "max_batch_tokens": args.max_batch_tokens, "prefix_cache": args.prefix_cache
+        }
+        # Only use stored summaries: strict mode raises on a miss, otherwise the day is skipped
+        self.strict_cache = args.strict_summary_cache
+        self.cache_only = args.summaries_only_from_cache or self.strict_cache
         # self.enc = tiktoken.encoding_for_model("gpt-3.5-turbo-16k")
         self.method_name = method_name
         
@@ -21,109 +36,198 @@ class Summarizer:
         tweet_dir = Path(args.tweet_dir)
         self.dataset_root = tweet_dir.parent
         self.summaries_dir = self.dataset_root / "summaries"
-        self.summaries_dir.mkdir(exist_ok=True)
         
-        # Get model name for the summary file
-        self.model_name = "Meta-Llama-3.1-8B-Instruct"
-        self.model_dir = self.summaries_dir / self.model_name
-        self.model_dir.mkdir(exist_ok=True)
+        # Get model name for the summary store
+        self.model_name = Path(self.base_model).name
         
-        # Create method-specific directory
-        self.method_dir = self.model_dir / self.method_name
-        self.method_dir.mkdir(exist_ok=True)
+        # Every setting that changes the prompts is part of the fingerprint
+        prompt_template = self.summarize_prompt + self.summarize_examples
+        if self.chunk_tokens > 0:
+            prompt_template += f"{self.reduce_prompt}{self.chunk_tokens}"
+        if args.tweet_filter:
+            prompt_template += f"tweet_filter{FILTER_VERSION}"
+        if args.relevance_top_k > 0:
+            prompt_template += f"relevance{args.relevance_model}{args.relevance_top_k}"
+        if self.max_prompt_tokens > 0:
+            prompt_template += f"max_prompt_tokens{self.max_prompt_tokens}"
+
+        generation_config = {"model": self.base_model, **GENERATION_KWARGS}
+        # Weights in another precision produce different summaries than float16 ones
+        if args.dtype != "float16":
+            generation_config["dtype"] = args.dtype
+
+        # Summaries of all models/methods share one SQLite file
+        self.store = SummaryStore(
+            self.summaries_dir, self.model_name, self.method_name,
+            generation_config=generation_config,
+            prompt_template=prompt_template,
+            tweet_states=TweetFileStates(args.tweet_dir, args.packed_tweet_dir or default_packed_tweet_dir(args.tweet_dir))
+        )
+
+    @property
+    def llm(self):
+        """The summarization model, loaded on the first cache miss."""
+        if self._llm is None:
+            self._llm = build_llm(self.llm_server, **self.llm_kwargs)
+        return self._llm
 
-    def get_summary_path(self, ticker, date):
-        """Get the path for a summary file."""
-        ticker_dir = self.method_dir / ticker
-        ticker_dir.mkdir(exist_ok=True)
-        return ticker_dir / f"{date}.json"
+    @property
+    def tokenizer(self):
+        """Tokenizer used to measure tweet chunks; loading it does not load the model."""
+        if self._tokenizer is None:
+            if self._llm is not None:
+                self._tokenizer = self._llm.tokenizer
+            else:
+                from transformers import AutoTokenizer
+                self._tokenizer = AutoTokenizer.from_pretrained(self.base_model)
+        return self._tokenizer
+
+    @property
+    def prompt_budget(self):
+        if self._prompt_budget is None:
+            self._prompt_budget = PromptBudget(self.tokenizer, self.max_prompt_tokens)
+        return self._prompt_budget
 
     def load_existing_summary(self, ticker, date):
         """Load an existing summary if it exists."""
-        summary_path = self.get_summary_path(ticker, date)
-        if summary_path.exists():
-            try:
-                with open(summary_path, 'r') as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                return None
-        return None
+        return self.store.load(ticker, date)
 
     def save_summary(self, ticker, date, tweet_data, prompt, summary):
-        """Save a summary to file."""
-        data = {
-            "ticker": ticker,
-            "date": date,
-            "tweet_data": tweet_data,
-            "prompt": prompt,
-            "summary": summary,
-            "model": self.model_name,
-            "method": self.method_name
-        }
-        
-        summary_path = self.get_summary_path(ticker, date)
+        """Save a summary to the store."""
         try:
-            with open(summary_path, 'w') as f:
-                json.dump(data, f, indent=4)
-        except Exception:
-            pass
-
-    def save_summary_data(self, file_path, ticker, date, tweet_data, prompt, summary):
-        data = {
-            "ticker": ticker,
-            "date": date,
-            "tweet_data": tweet_data,
-            "prompt": prompt,
-            "summary": summary
-        }
+            self.store.save(ticker, date, tweet_data, prompt, summary)
+        except Exception as e:
+            print(f"Error saving the summary of {ticker} on {date}: {e!r}")
 
-        # 讀取現有的 JSON 檔案
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as f:
-                try:
-                    existing_data = json.load(f)  # 讀取 JSON 陣列
-                except json.JSONDecodeError:
-                    existing_data = []  # 如果讀取失敗，初始化為空陣列
-        else:
-            existing_data = []  # 檔案不存在時，初始化為空陣列
-        
-        # 加入新的數據
-        existing_data.append(data)
+    def generate(self, prompts):
+        """Responses to a list of prompts; None where generation failed.
 
-        # 重新寫回完整的 JSON 陣列
-        with open(file_path, 'w') as f:
-            json.dump(existing_data, f, indent=4)
+        A failed response is never stored, otherwise it would stand as the
+        summary of its day for good; the day is generated again next run.
+        """
+        try:
+            responses = self.llm.generate_batch(prompts)
+        except Exception as e:
+            print(f"Summary generation of {len(prompts)} prompts failed, retried on the next run: {e!r}")
+            return [None] * len(prompts)
+        return [response if isinstance(response, str) else None for response in responses]
 
-    def get_summary(self, ticker, date_str, tweets):
-        # First check if summary already exists
-        existing_summary = self.load_existing_summary(ticker, date_str)
-        if existing_summary:
-            return existing_summary["summary"]
+    def find_stored_summary(self, ticker, date_str, prompt, key):
+        """Stored summary for a rendered prompt, as (summary,), or None.
 
-        # If no existing summary, generate new one
-        summary = None
-        if tweets:
-            prompt = self.summarize_prompt.format(
+        The prompt is looked up by content key first; a ticker-day indexed
+        under an older fingerprint is reused only if its stored prompt is
+        exactly the prompt rendered now.
+        """
+        content = self.store.get_content(key)
+        if content is not None:
+            return (content[0],)
+        indexed = self.store.load_indexed(ticker, date_str)
+        if indexed is not None and indexed[1] == prompt:
+            return (indexed[0],)
+        return None
+
+    def build_prompt(self, ticker, tweets):
+        def render(kept):
+            return self.summarize_prompt.format(
                 ticker=ticker,
                 examples=self.summarize_examples,
-                tweets="\n".join(tweets)
+                tweets="\n".join(kept)
             )
 
-            # gpt-3.5-turbo-16k
-            # while len(self.enc.encode(prompt)) > 16385:
-            #     tweets = tweets[:-1]
-            #     prompt = self.summarize_prompt.format(
-            #                             ticker = ticker,
-            #                             examples = self.summarize_examples,
-            #                             tweets = "\n".join(tweets))
+        if self.max_prompt_tokens <= 0:
+            return render(tweets)
+        # Over --max_prompt_tokens the first tweets of the day are kept
+        prompt, _ = self.prompt_budget.fit(render, tweets, keep="head")
+        return prompt
+
+    def split_tweets(self, tweets):
+        """Split a day's tweets into consecutive chunks of at most `--summary_chunk_tokens` tokens.
+
+        Chunks are filled greedily in tweet order, so tweets appended to a day
+        leave its earlier chunks, and their cached summaries, unchanged. A
+        tweet longer than the budget forms a chunk of its own.
+        """
+        chunks, chunk, chunk_tokens = [], [], 0
+        for tweet in tweets:
+            num_tokens = self.prompt_budget.count(tweet)
+            if chunk and chunk_tokens + num_tokens > self.chunk_tokens:
+                chunks.append(chunk)
+                chunk, chunk_tokens = [], 0
+            chunk.append(tweet)
+            chunk_tokens += num_tokens
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def summarize_chunks(self, ticker, date_str, chunks):
+        """Map step: one summary per chunk, or None if a chunk cannot be generated (cache-only modes, failed generation).
+
+        Chunk summaries are stored by content key only and the missing ones
+        are generated in one batch.
+        """
+        prompts = [self.build_prompt(ticker, chunk) for chunk in chunks]
+        summaries = []
+        missing = []
+        for prompt in prompts:
+            content = self.store.get_content(self.store.content_key(prompt))
+            summaries.append(content[0] if content is not None else None)
+            if content is None and prompt not in missing:
+                missing.append(prompt)
+        if missing:
+            if self.strict_cache:
+                raise RuntimeError(f"No stored summary for {ticker} on {date_str} (--strict_summary_cache)")
+            if self.cache_only:
+                return None
+            generated = dict(zip(missing, self.generate(missing)))
+            self.store.save_contents([(prompt, summary) for prompt, summary in generated.items() if summary is not None])
+            summaries = [generated.get(prompt, summary) for prompt, summary in zip(prompts, summaries)]
+            # a day whose chunks are not all summarized is not merged
+            if None in summaries:
+                return None
+        return summaries
+
+    def build_reduce_prompt(self, ticker, chunk_summaries):
+        parts = "\n\n".join(f"Part {n}:\n{summary}" for n, summary in enumerate(chunk_summaries, 1))
+        return self.reduce_prompt.format(ticker=ticker, summaries=parts)
+
+    def get_summary(self, ticker, date_str, tweets):
+        summary = None
+        if tweets:
+            chunks = self.split_tweets(tweets) if self.chunk_tokens > 0 else [tweets]
+            if len(chunks) > 1:
+                # Too many tweets for one prompt: summarize the chunks, then merge their summaries
+                chunk_summaries = self.summarize_chunks(ticker, date_str, chunks)
+                if chunk_summaries is None:
+                    return None
+                prompt = self.build_reduce_prompt(ticker, chunk_summaries)
+            else:
+                prompt = self.build_prompt(ticker, tweets)
+
+            # Summaries are cached by a hash of (model, generation settings, rendered prompt)
+            key = self.store.content_key(prompt)
+            # The index is trusted only if it points at the prompt rendered from the current tweets
+            existing_summary = self.load_existing_summary(ticker, date_str)
+            if existing_summary and existing_summary["key"] == key:
+                return existing_summary["summary"]
+            stored = self.find_stored_summary(ticker, date_str, prompt, key)
+            if stored is not None:
+                self.save_summary(ticker, date_str, tweets, prompt, stored[0])
+                return stored[0]
+
+            # If no existing summary, generate new one
+            if self.strict_cache:
+                raise RuntimeError(f"No stored summary for {ticker} on {date_str} (--strict_summary_cache)")
+            if self.cache_only:
+                return None
 
-            summary = self.llm(prompt)
+            summary = self.generate([prompt])[0]
 
             # Save the new summary
-            self.save_summary(ticker, date_str, tweets, prompt, summary)
+            if summary is not None:
+                self.save_summary(ticker, date_str, tweets, prompt, summary)
 
         return summary
 
     def is_informative(self, summary):
-        neg = r'.*[nN]o.*information.*|.*[nN]o.*facts.*|.*[nN]o.*mention.*|.*[nN]o.*tweets.*|.*do not contain.*'
-        return not re.match(neg, summary)
+        return is_informative(summary)
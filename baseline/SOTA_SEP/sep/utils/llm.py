@@ -1,51 +1,180 @@
-import openai
+# openai, torch and transformers are imported where they are used, so that
+# importing this module (and everything that imports it) stays cheap
+import json
+import urllib.error
+import urllib.request
 from tenacity import (
     retry,
     stop_after_attempt, # type: ignore
     wait_random_exponential, # type: ignore
 )
 # from fastchat.model import get_conversation_template
-import torch
-from transformers import LlamaForCausalLM, AutoTokenizer, pipeline
+from utils.model_registry import generate_lock, get_model
+from utils.prefix_cache import PrefixCache, group_by_prefix
+
+BASE_MODEL = "meta-llama/Meta-Llama-3.1-8B-Instruct"
+# Sampling settings of every generation; also part of the summary cache key
+GENERATION_KWARGS = {"max_new_tokens": 512}
+
+
+def length_buckets(lengths, batch_size, max_batch_tokens=0, new_tokens=0):
+    """Group prompt indices into batches of similar length, longest batch first.
+
+    A batch holds at most `batch_size` prompts and, when `max_batch_tokens`
+    is set, at most that many tokens counted as rows x (longest prompt +
+    `new_tokens`); a prompt over the budget on its own gets its own batch.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    for i in order:
+        if batches:
+            batch = batches[-1]
+            # sorted longest first, so the first prompt sets the padded width of the batch
+            width = lengths[batch[0]] + new_tokens
+            if len(batch) < batch_size and (max_batch_tokens <= 0 or (len(batch) + 1) * width <= max_batch_tokens):
+                batch.append(i)
+                continue
+        batches.append([i])
+    return batches
 
 class LLaMALLM:
-    def __init__(self):
-        # Load Tokenizer and Model
-        self.base_model = "meta-llama/Meta-Llama-3.1-8B-Instruct"
-        self.tokenizer = AutoTokenizer.from_pretrained(self.base_model)
-        # Set PAD Token
-        PAD_TOKEN = "<|pad|>"
-        self.tokenizer.add_special_tokens({"pad_token": PAD_TOKEN})
-        self.tokenizer.padding_side = "right"
-        
-        self.model = LlamaForCausalLM.from_pretrained(
-            self.base_model, 
-            torch_dtype=torch.float16,
-            device_map="auto"
-        )
-
-        self.text_gen_pipeline = pipeline(
-            task="text-generation",
-            batch_size=8,
-            model=self.model,
-            tokenizer=self.tokenizer,
-            max_new_tokens=512,
-            return_full_text=False
-        )
+    def __init__(self, generation_kwargs=None, batch_size=8, max_batch_tokens=0, base_model=BASE_MODEL, dtype="float16", prefix_cache=False):
+        # Load Tokenizer and Model (shared by every LLaMALLM of the process)
+        self.base_model = base_model
+        self.tokenizer, self.model = get_model(self.base_model, dtype)
+        self.generation_kwargs = GENERATION_KWARGS if generation_kwargs is None else generation_kwargs
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        # the prefix shared by prompts (instruction, ticker, few-shot examples) is prefilled once
+        self.prefix_cache = PrefixCache(self.model) if prefix_cache else None
 
     def create_chat_format_data(self, system_prompt, user_prompt):
         return [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
 
     def __call__(self, user_prompt):
-        chat_format_data = self.create_chat_format_data("", user_prompt)
-
-        prompt = self.tokenizer.apply_chat_template(
-            chat_format_data, tokenize=False, add_generation_prompt=True
+        return self.generate_batch([user_prompt])[0]
+
+    def generate_batch(self, user_prompts):
+        """Responses to a list of user prompts, in input order.
+
+        Prompts are left-padded and grouped by token length (see
+        `length_buckets`) into batches of at most `batch_size` prompts and
+        `max_batch_tokens` tokens, so little compute goes to padding. Each
+        prompt is tokenized once; its ids go to the model as they are.
+        """
+        prompts = [
+            self.tokenizer.apply_chat_template(
+                self.create_chat_format_data("", user_prompt), tokenize=False, add_generation_prompt=True
+            )
+            for user_prompt in user_prompts
+        ]
+        if not prompts:
+            return []
+        rows = [tuple(ids) for ids in self.tokenizer(prompts, add_special_tokens=False)["input_ids"]]
+        if self.prefix_cache is not None:
+            return self._generate_with_prefix_cache(rows)
+        batches = length_buckets(
+            [len(row) for row in rows], self.batch_size, self.max_batch_tokens, self.generation_kwargs.get("max_new_tokens", 0)
         )
 
-        response = self.text_gen_pipeline(prompt)[0]['generated_text']
+        responses = [None] * len(rows)
+        for batch in batches:
+            for i, output in zip(batch, self._generate_ids([rows[i] for i in batch])):
+                responses[i] = output
+        return responses
+
+    def _generate_with_prefix_cache(self, rows):
+        """generate_batch over token rows grouped by shared prefix, each group reusing the prefix's KV cache."""
+        responses = [None] * len(rows)
+        for prefix_length, members in group_by_prefix(rows, self.prefix_cache.min_tokens):
+            if len(members) > 1:
+                prefix = rows[members[0]][:prefix_length]
+            else:
+                prefix = self.prefix_cache.lookup(rows[members[0]])
+            batches = length_buckets(
+                [len(rows[i]) for i in members], self.batch_size, self.max_batch_tokens,
+                self.generation_kwargs.get("max_new_tokens", 0)
+            )
+            for batch in batches:
+                batch = [members[j] for j in batch]
+                for i, output in zip(batch, self._generate_ids([rows[i] for i in batch], prefix)):
+                    responses[i] = output
+        return responses
+
+    def _generate_ids(self, rows, prefix=()):
+        import torch
+
+        pad = self.tokenizer.pad_token_id
+        n = len(prefix)
+        width = max(len(row) for row in rows) - n
+        # padding goes between prefix and suffix so every row keeps the prefix at the
+        # positions of the shared cache; position ids follow from the attention mask
+        input_ids = [list(prefix) + [pad] * (width - len(row) + n) + list(row[n:]) for row in rows]
+        attention_mask = [[1] * n + [0] * (width - len(row) + n) + [1] * (len(row) - n) for row in rows]
+        # the summarizer of the prefetch thread and the agents share the model; generate calls take turns
+        with generate_lock(self.model), torch.no_grad():
+            # prefilling the prefix cache runs the model too
+            cache_kwargs = {"past_key_values": self.prefix_cache.copy_for(prefix, len(rows))} if n else {}
+            output_ids = self.model.generate(
+                input_ids=torch.tensor(input_ids, device=self.model.device),
+                attention_mask=torch.tensor(attention_mask, device=self.model.device),
+                pad_token_id=pad,
+                **cache_kwargs,
+                **self.generation_kwargs
+            )
+        return self.tokenizer.batch_decode(output_ids[:, n + width:], skip_special_tokens=True)
+
+class RemoteLLM:
+    """Client of a `utils.llm_server` daemon with the interface of LLaMALLM.
+
+    Every request names the model, dtype and generation settings of this
+    process; the server refuses requests for a model it does not run.
+    """
+    def __init__(self, url, generation_kwargs=None, base_model=BASE_MODEL, dtype="float16"):
+        self.url = url.rstrip("/")
+        self.generation_kwargs = GENERATION_KWARGS if generation_kwargs is None else generation_kwargs
+        self.base_model = base_model
+        self.dtype = dtype
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        # only the tokenizer is loaded here, for prompt budgets; the model lives in the server
+        if self._tokenizer is None:
+            from transformers import AutoTokenizer
+            self._tokenizer = AutoTokenizer.from_pretrained(self.base_model)
+        return self._tokenizer
+
+    def __call__(self, user_prompt):
+        return self.generate_batch([user_prompt])[0]
+
+    def generate_batch(self, user_prompts):
+        """Responses to a list of user prompts, in input order, batched by the server."""
+        if not user_prompts:
+            return []
+        body = json.dumps({
+            "model": self.base_model,
+            "dtype": self.dtype,
+            "generation_kwargs": self.generation_kwargs,
+            "prompts": user_prompts
+        }).encode("utf-8")
+        request = urllib.request.Request(f"{self.url}/generate", data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())["responses"]
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"Inference server error {e.code}: {e.read().decode('utf-8', errors='replace')}") from e
+
+
+def build_llm(llm_server="", base_model=BASE_MODEL, dtype="float16", **llm_kwargs):
+    """A client of the `llm_server` daemon if one is given, else a LLaMALLM loaded in this process.
+
+    The server only answers requests for the `base_model` and `dtype` it runs.
+    """
+    if llm_server:
+        return RemoteLLM(llm_server, llm_kwargs.get("generation_kwargs"), base_model, dtype)
+    return LLaMALLM(base_model=base_model, dtype=dtype, **llm_kwargs)
 
-        return response
 
 class OpenAILLM:
     def __init__(self):
@@ -53,6 +182,8 @@ class OpenAILLM:
 
     @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
     def __call__(self, prompt):
+        import openai
+
         messages = [{"role": "user", "content": prompt}]
         completion = openai.chat.completions.create(model=self.model, messages=messages)
         response = completion.choices[0].message.content
@@ -65,6 +196,8 @@ class FastChatLLM:
         self.tokenizer = tokenizer
 
     def __call__(self, prompt):
+        import torch
+
         conv = get_conversation_template('vicuna-7b-1.5')
         conv.append_message(conv.roles[0], prompt)
         conv.append_message(conv.roles[1], None)
@@ -95,6 +228,8 @@ class NShotLLM:
         return [output["score"] for output in self.reward_model(list_of_strings)]
 
     def __call__(self, prompt):
+        import torch
+
         query = self.tokenizer.encode(prompt, return_tensors="pt")
         queries = query.repeat((self.num_shots, 1))
         output_ids = self.model.generate(
@@ -0,0 +1,187 @@
+"""Long-lived local inference server: one warm model shared by every job on the machine.
+
+    python -m utils.llm_server --port 8765
+    python main.py --llm_server http://127.0.0.1:8765 ...
+
+Requests that arrive while a batch is generating wait in a queue and are
+merged into the next batch, where LLaMALLM.generate_batch buckets them by
+length, so the summarizer, predict and reflect calls of concurrent jobs
+share forward passes. Requests with different generation settings are
+batched separately over the same weights. For a CPU-only test setup, serve
+a small Llama chat model in float32 and run main.py with the same model:
+
+    CUDA_VISIBLE_DEVICES= python -m utils.llm_server --base_model TinyLlama/TinyLlama-1.1B-Chat-v1.0 --dtype float32
+    python main.py --llm_server http://127.0.0.1:8765 --base_model TinyLlama/TinyLlama-1.1B-Chat-v1.0 --dtype float32 ...
+"""
+import json
+import time
+import queue
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.llm import BASE_MODEL, GENERATION_KWARGS, LLaMALLM
+
+
+class PendingRequest:
+    def __init__(self, generation_kwargs, prompts):
+        self.generation_kwargs = generation_kwargs
+        self.key = json.dumps(generation_kwargs, sort_keys=True)
+        self.prompts = prompts
+        self.responses = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchScheduler:
+    """Runs queued requests on one thread, merging those with the same generation settings."""
+    def __init__(self, args):
+        self.args = args
+        self.queue = queue.Queue()
+        self.llms = {}
+        self.thread = threading.Thread(target=self.run, name="batch-scheduler", daemon=True)
+
+    def start(self):
+        # load the model up front so the first request does not wait for it
+        self.llm(PendingRequest(GENERATION_KWARGS, []))
+        self.thread.start()
+
+    def submit(self, generation_kwargs, prompts):
+        """Block until the responses of `prompts` are generated."""
+        request = PendingRequest(generation_kwargs, prompts)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.responses
+
+    def llm(self, request):
+        # one LLaMALLM per generation setting, all over the registry's shared weights
+        if request.key not in self.llms:
+            self.llms[request.key] = LLaMALLM(
+                request.generation_kwargs, self.args.batch_size, self.args.max_batch_tokens,
+                base_model=self.args.base_model, dtype=self.args.dtype, prefix_cache=self.args.prefix_cache
+            )
+        return self.llms[request.key]
+
+    def collect(self, pending):
+        """Add queued requests to `pending`, waiting up to --max_wait_ms while the next batch is not full."""
+        if not pending:
+            pending.append(self.queue.get())
+        deadline = time.time() + self.args.max_wait_ms / 1000
+        while sum(len(request.prompts) for request in pending if request.key == pending[0].key) < self.args.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        while True:
+            try:
+                pending.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+    def run(self):
+        pending = []
+        while True:
+            self.collect(pending)
+            # oldest request first; every queued request with its settings joins the batch
+            key = pending[0].key
+            batch = [request for request in pending if request.key == key]
+            pending = [request for request in pending if request.key != key]
+
+            prompts = [prompt for request in batch for prompt in request.prompts]
+            try:
+                responses = self.llm(batch[0]).generate_batch(prompts)
+            except Exception as e:
+                print(f"Batch of {len(prompts)} prompts failed: {e!r}")
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+
+            start = 0
+            for request in batch:
+                request.responses = responses[start:start + len(request.prompts)]
+                start += len(request.prompts)
+                request.done.set()
+
+
+class LLMRequestHandler(BaseHTTPRequestHandler):
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.reply(200, self.server.model_info)
+        else:
+            self.reply(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self.reply(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            prompts = [str(prompt) for prompt in body["prompts"]]
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply(400, {"error": f"malformed request: {e}"})
+            return
+
+        mismatch = {key: body.get(key) for key, value in self.server.model_info.items() if body.get(key) != value}
+        if mismatch:
+            self.reply(409, {"error": f"server runs {self.server.model_info}, request asked for {mismatch}"})
+            return
+
+        try:
+            responses = self.server.scheduler.submit(body.get("generation_kwargs", GENERATION_KWARGS), prompts)
+        except Exception as e:
+            self.reply(500, {"error": repr(e)})
+            return
+        self.reply(200, {"responses": responses})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, args):
+        super().__init__((args.host, args.port), LLMRequestHandler)
+        self.model_info = {"model": args.base_model, "dtype": args.dtype}
+        self.scheduler = BatchScheduler(args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve a warm model to main.py --llm_server")
+    parser.add_argument("--base_model", type=str, default=BASE_MODEL)
+    parser.add_argument("--dtype", type=str, default="float16", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--prefix_cache", action="store_true", help="prefill the token prefix shared by a batch's prompts once and reuse its KV cache")
+    parser.add_argument("--max_batch_tokens", type=int, default=0, help="cap a generation batch at this many tokens, rows x (longest prompt + max_new_tokens) (0 = only --batch_size)")
+    parser.add_argument("--max_wait_ms", type=float, default=20, help="how long a request may wait for others to fill its batch")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = LLMServer(args)
+    server.scheduler.start()
+    print(f"Serving {args.base_model} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import threading
+
+PAD_TOKEN = "<|pad|>"
+
+_models = {}
+_lock = threading.Lock()
+_generate_locks = {}
+
+
+def _quantization_config(quantization):
+    import torch
+    from transformers import BitsAndBytesConfig
+
+    if quantization == "4bit":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4"
+        )
+    if quantization == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    return None
+
+
+def get_model(model_id, dtype="float16", quantization="none"):
+    """Shared (tokenizer, model) for (model_id, dtype, quantization), loaded once per process.
+
+    The summarizer and the predict/reflect agents all wrap the same weights
+    in their own LLaMALLM with their own generation settings.
+    """
+    import torch
+    from transformers import AutoTokenizer, LlamaForCausalLM
+
+    key = (model_id, dtype, quantization)
+    # the sample prefetch thread may ask for the model at the same time
+    with _lock:
+        if key not in _models:
+            print(f"Loading {model_id} ({dtype}, quantization={quantization})...")
+            tokenizer = AutoTokenizer.from_pretrained(model_id)
+            # Set PAD Token
+            tokenizer.add_special_tokens({"pad_token": PAD_TOKEN})
+            # Left padding so batched generation continues right after each prompt
+            tokenizer.padding_side = "left"
+
+            model = LlamaForCausalLM.from_pretrained(
+                model_id,
+                torch_dtype=getattr(torch, dtype),
+                device_map="auto",
+                quantization_config=_quantization_config(quantization)
+            )
+            # The added pad token needs an embedding row once batches are actually padded
+            model.resize_token_embeddings(len(tokenizer))
+            _models[key] = (tokenizer, model)
+            _generate_locks[id(model)] = threading.Lock()
+        return _models[key]
+
+
+def generate_lock(model):
+    """Lock to hold around `generate` on a registry model.
+
+    The summarizer of the sample prefetch thread and the train agents share
+    one model, and generate is not thread-safe; their calls take turns,
+    while tweet reading and prompt building still overlap.
+    """
+    return _generate_locks[id(model)]
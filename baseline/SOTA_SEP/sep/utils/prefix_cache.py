@@ -0,0 +1,86 @@
+import copy
+from collections import OrderedDict
+
+# shorter shared prefixes are not worth a separate prefill
+MIN_PREFIX_TOKENS = 32
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def group_by_prefix(rows, min_tokens=MIN_PREFIX_TOKENS):
+    """Group token-id rows that share a prefix of at least `min_tokens`, as (prefix length, indices) pairs.
+
+    Rows are visited in sorted order, where the common prefix of a run of
+    rows is the one of its first and last row. The prefix of a group stops
+    at least one token before its shortest row, which generate() still needs
+    as input. A row that shares less with its neighbours is a group of its own.
+    """
+    order = sorted(range(len(rows)), key=lambda i: rows[i])
+    groups = []
+    for i in order:
+        if groups:
+            length, members = groups[-1]
+            shared = min(length, common_prefix_length(rows[members[0]], rows[i]), len(rows[i]) - 1)
+            if shared >= min_tokens:
+                groups[-1] = (shared, members + [i])
+                continue
+        groups.append((len(rows[i]) - 1, [i]))
+    return groups
+
+
+class PrefixCache:
+    """past_key_values of shared prompt prefixes, prefilled once and copied into every generate() that reuses them.
+
+    The static head of a prompt (chat header, instruction, ticker and
+    few-shot examples) is encoded once per distinct prefix; each batch gets
+    its own copy of the cache, repeated over its rows, since generation
+    appends to it. The `max_entries` most recently used prefixes are kept.
+    """
+
+    def __init__(self, model, min_tokens=MIN_PREFIX_TOKENS, max_entries=8):
+        self.model = model
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.reused_tokens = 0
+
+    def lookup(self, row):
+        """The longest stored prefix of `row` that leaves at least one token, or an empty tuple."""
+        best = ()
+        for prefix in self.entries:
+            if len(best) < len(prefix) < len(row) and row[:len(prefix)] == prefix:
+                best = prefix
+        return best
+
+    def get(self, prefix):
+        import torch
+        from transformers import DynamicCache
+
+        if prefix in self.entries:
+            self.entries.move_to_end(prefix)
+            return self.entries[prefix]
+        cache = DynamicCache()
+        with torch.no_grad():
+            self.model(
+                input_ids=torch.tensor([prefix], device=self.model.device),
+                past_key_values=cache,
+                use_cache=True
+            )
+        self.entries[prefix] = cache
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return cache
+
+    def copy_for(self, prefix, batch_size):
+        """A private copy of the prefix's cache with one row per batch row."""
+        cache = copy.deepcopy(self.get(prefix))
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        self.reused_tokens += len(prefix) * batch_size
+        return cache
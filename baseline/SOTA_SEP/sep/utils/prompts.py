@@ -35,6 +35,20 @@ Tweets:
 Summary:"""
 
 
+MY_SUMMARIZE_REDUCE_INSTRUCTION = """The following summaries each cover a part of today's tweets about {ticker} stock.
+Merge them into one **concise, fact-based summary** of the day.
+
+Rules:
+- Keep every distinct financial fact exactly once.
+- Do not add facts, speculation or sentiment that the partial summaries do not contain.
+- Use concise bullet points. Each point should be max one sentence.
+
+Partial summaries:
+{summaries}
+
+Summary:"""
+
+
 PREDICT_INSTRUCTION = """Given a list of facts, estimate their overall impact on the price movement of {ticker} stock. Give your response in this format:
 (1) Price Movement, which should be either Positive or Negative.
 (2) Explanation, which should be in a single, short paragraph.
@@ -0,0 +1,139 @@
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from utils import llm_server
+from utils.llm import GENERATION_KWARGS, RemoteLLM
+
+
+class StubLLM:
+    """Stands in for LLaMALLM: answers each prompt with the prompt itself and records every batch."""
+    batches = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def __init__(self, generation_kwargs=None, batch_size=8, max_batch_tokens=0, base_model=None, dtype=None, prefix_cache=False):
+        self.generation_kwargs = generation_kwargs
+
+    def generate_batch(self, user_prompts):
+        StubLLM.batches.append(list(user_prompts))
+        if "block" in user_prompts:
+            # hold this batch so that later requests wait in the queue and form the next one
+            StubLLM.started.set()
+            StubLLM.release.wait(10)
+        if "fail" in user_prompts:
+            raise RuntimeError("stub failure")
+        return [f"{self.generation_kwargs['max_new_tokens']}:{prompt}" for prompt in user_prompts]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    StubLLM.batches = []
+    StubLLM.started = threading.Event()
+    StubLLM.release = threading.Event()
+    monkeypatch.setattr(llm_server, "LLaMALLM", StubLLM)
+    args = argparse.Namespace(
+        base_model="stub-model", dtype="float32", batch_size=8, max_batch_tokens=0,
+        prefix_cache=False, max_wait_ms=0, host="127.0.0.1", port=0
+    )
+    server = llm_server.LLMServer(args)
+    server.scheduler.start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    StubLLM.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def client(server, base_model="stub-model", generation_kwargs=None):
+    return RemoteLLM(f"http://127.0.0.1:{server.server_address[1]}", generation_kwargs, base_model, "float32")
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_responses_in_request_order(server):
+    assert client(server).generate_batch(["a", "b", "c"]) == [f"{GENERATION_KWARGS['max_new_tokens']}:{prompt}" for prompt in "abc"]
+    assert StubLLM.batches == [["a", "b", "c"]]
+
+
+def test_queued_requests_share_a_batch(server):
+    blocker = threading.Thread(target=client(server).generate_batch, args=(["block"],))
+    blocker.start()
+    assert StubLLM.started.wait(10)
+
+    # requests sent while the first batch generates wait in the queue
+    requests = [["r1-a", "r1-b"], ["r2-a"], ["r3-a", "r3-b", "r3-c"]]
+    results = {}
+
+    def send(prompts):
+        results[prompts[0]] = client(server).generate_batch(prompts)
+
+    threads = [threading.Thread(target=send, args=(prompts,)) for prompts in requests]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: server.scheduler.queue.qsize() == len(requests))
+    StubLLM.release.set()
+    for thread in threads + [blocker]:
+        thread.join(10)
+
+    # the three requests form one batch and each gets back only its own responses
+    assert len(StubLLM.batches) == 2
+    assert sorted(StubLLM.batches[1]) == sorted(prompt for prompts in requests for prompt in prompts)
+    for prompts in requests:
+        assert results[prompts[0]] == [f"{GENERATION_KWARGS['max_new_tokens']}:{prompt}" for prompt in prompts]
+
+
+def test_generation_settings_are_batched_separately(server):
+    blocker = threading.Thread(target=client(server).generate_batch, args=(["block"],))
+    blocker.start()
+    assert StubLLM.started.wait(10)
+
+    results = {}
+    short = {**GENERATION_KWARGS, "max_new_tokens": 4}
+    threads = [
+        threading.Thread(target=lambda: results.setdefault("default", client(server).generate_batch(["x"]))),
+        threading.Thread(target=lambda: results.setdefault("short", client(server, generation_kwargs=short).generate_batch(["y"])))
+    ]
+    for thread in threads:
+        thread.start()
+    wait_for(lambda: server.scheduler.queue.qsize() == 2)
+    StubLLM.release.set()
+    for thread in threads + [blocker]:
+        thread.join(10)
+
+    assert sorted(StubLLM.batches[1:]) == [["x"], ["y"]]
+    assert results == {"default": [f"{GENERATION_KWARGS['max_new_tokens']}:x"], "short": ["4:y"]}
+
+
+def test_failed_batch_keeps_serving(server):
+    with pytest.raises(RuntimeError, match="500"):
+        client(server).generate_batch(["fail", "other"])
+    # only the failed batch is affected
+    assert client(server).generate_batch(["ok"]) == [f"{GENERATION_KWARGS['max_new_tokens']}:ok"]
+
+
+def test_other_model_is_refused(server):
+    with pytest.raises(RuntimeError, match="409"):
+        client(server, base_model="other-model").generate_batch(["a"])
+    assert StubLLM.batches == []
+
+
+def test_malformed_request(server):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{server.server_address[1]}/generate",
+        data=json.dumps({"model": "stub-model"}).encode("utf-8"),
+        headers={"Content-Type": "application/json"}
+    )
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request)
+    assert error.value.code == 400